@@ -0,0 +1,51 @@
+"""Compare Resolver against the recursive get_response walk.
+
+Run from the repository root:
+
+    python benchmarks/resolver.py
+"""
+import os
+import random
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from sinpy import get_response, Resolver, Resource
+
+
+def make_site(routes, width=10):
+    def leaf(self):
+        return 'LEAF'
+
+    sections = {}
+    for i in range(routes // width):
+        members = dict(('page%d' % j, Resource(leaf)) for j in range(width))
+        sections['section%d' % i] = type('Section', (Resource,), members)()
+
+    return type('Site', (Resource,), sections)()
+
+
+def paths(routes, width=10, count=1000):
+    return ['/section%d/page%d' % (random.randrange(routes // width),
+                                    random.randrange(width))
+            for _ in range(count)]
+
+
+def bench(routes):
+    site = make_site(routes)
+    resolver = Resolver(site)
+    sample = paths(routes)
+
+    recursive = timeit(lambda: [get_response(site, 'GET', p) for p in sample],
+                       number=10)
+    trie = timeit(lambda: [resolver(site, 'GET', p) for p in sample],
+                  number=10)
+
+    print('%6d routes: get_response %.3fs, Resolver %.3fs (%.1fx)' % (
+        routes, recursive, trie, recursive / trie))
+
+
+if __name__ == '__main__':
+    for routes in 1000, 10000:
+        bench(routes)
@@ -0,0 +1,298 @@
+"""Benchmarks for routing, dispatch, binding, Static, templates and body
+streaming.
+
+Every scenario drives the WSGI callable in-process with synthetic environs,
+except for the dispatch, binding and template ones, which call
+Dispatcher.get, Resource.__get__ and the renderers directly. For each scenario the suite reports
+requests/sec, p50/p99 latency and memory per request:
+
+peak_bytes
+    Peak memory allocated while serving one request. Only reported on
+    Pythons with tracemalloc.
+retained
+    Objects that survive a request, averaged over the run, with the cyclic
+    collector disabled. Anything above zero means a leak or a growing
+    cache.
+
+Run from the repository root:
+
+    python benchmarks/suite.py --output results.json
+    python benchmarks/suite.py --compare results.json
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from sinpy import (Coalescing, Dispatcher, FLUSH, Resource, Static,
+                   StaticCache, Template)
+from sinpy.template import escape
+
+
+def make_tree(depth, width):
+    """Return a Resource tree ``depth`` levels deep with ``width`` members
+    per level, and the path of its deepest, last leaf.
+    """
+    def leaf(self):
+        return 'LEAF'
+
+    members = dict(('page%d' % i, Resource(leaf)) for i in range(width))
+    path = ['page%d' % (width - 1)]
+    for level in range(depth - 1):
+        node = type('Level%d' % level, (Resource,), dict(members))()
+        members = dict(('node%d' % i, node) for i in range(width))
+        path.insert(0, 'node%d' % (width - 1))
+
+    return type('Site', (Resource,), members)(), '/' + '/'.join(path)
+
+
+def make_routes(count):
+    """Return a Resource with ``count`` members, half of them reachable
+    through custom string routes and half through regex routes.
+    """
+    dispatcher = Dispatcher()
+
+    def leaf(self):
+        return 'ROUTE'
+
+    members = {}
+    for i in range(count):
+        member = members['member%d' % i] = Resource(leaf)
+        if i % 2:
+            dispatcher.route(re=r'item%d-(?P<id>\d+)' % i)(member)
+        else:
+            dispatcher.route('alias-%d.html' % i)(member)
+
+    return (type('Site', (Resource,), members)(),
+            ['/alias-%d.html' % (count - 2), '/item%d-42' % (count - 1)])
+
+
+def make_stream(chunks, coalescing=None):
+    class Site(Resource):
+        _coalescing = coalescing
+
+        def get(self):
+            for i in range(chunks):
+                yield '<li>%d</li>' % i
+            yield FLUSH
+
+    return Site()
+
+
+LIST_TEMPLATE = Template('<h1>Items</h1><ul>{% for item in items %}'
+                         '<li><a href="{{ item["url"] }}">{{ item["title"] }}'
+                         '</a></li>{% endfor %}</ul>')
+
+
+def render_format(items):
+    """What LIST_TEMPLATE renders, with %-formatting and the same escaping,
+    batched like Static listings were before templates.
+    """
+    batch = ['<h1>Items</h1><ul>']
+    chunks = []
+    for item in items:
+        batch.append('<li><a href="%s">%s</a></li>' % (escape(item['url']),
+                                                       escape(item['title'])))
+        if len(batch) >= 256:
+            chunks.append(''.join(batch))
+            batch = []
+    batch.append('</ul>')
+    chunks.append(''.join(batch))
+    return ''.join(chunks)
+
+
+def environ(path, method='GET'):
+    return {'REQUEST_METHOD': method, 'PATH_INFO': path,
+            'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80', 'wsgi.url_scheme': 'http'}
+
+
+def wsgi_request(application, path):
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    def request():
+        result = application(environ(path), start_response)
+        for _ in result:
+            pass
+        if hasattr(result, 'close'):
+            result.close()
+
+    return request
+
+
+def measure(request, count):
+    for _ in range(min(count // 10, 100)):
+        request()
+
+    latencies = []
+    gc.collect()
+    gc.disable()
+    try:
+        retained = len(gc.get_objects())
+        started = default_timer()
+        for _ in range(count):
+            before = default_timer()
+            request()
+            latencies.append(default_timer() - before)
+        elapsed = default_timer() - started
+        retained = float(len(gc.get_objects()) - retained) / count
+    finally:
+        gc.enable()
+
+    peak_bytes = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            request()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    latencies.sort()
+    return {'requests': count,
+            'requests_per_sec': count / elapsed,
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+            'retained': retained,
+            'peak_bytes': peak_bytes}
+
+
+def scenarios(directory):
+    for depth, width in (1, 10), (5, 10), (10, 10), (5, 100):
+        site, path = make_tree(depth, width)
+        yield ('routing/depth=%d,width=%d' % (depth, width),
+               wsgi_request(site, path))
+
+    for count in 10, 100, 1000:
+        site, paths = make_routes(count)
+        for kind, path in zip(('string', 'regex'), paths):
+            yield ('routes/%s,count=%d' % (kind, count),
+                   wsgi_request(site, path))
+
+    site, _ = make_routes(100)
+    dispatcher = Dispatcher()
+    yield 'dispatch/attribute', lambda: dispatcher.get(site, 'member50')
+    yield 'dispatch/regex', lambda: dispatcher.get(site, 'item99-1')
+
+    class Bound(Resource):
+        @Resource
+        def member(self):
+            return 'BOUND'
+    bound = Bound()
+    yield 'bind/__get__', lambda: bound.member
+
+    for size in 1024, 1024 * 1024:
+        name = 'file%d' % size
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(b'x' * size)
+
+        class Files(Resource):
+            static = Static(directory)
+            cached = Static(directory, cache=StaticCache())
+
+        site = Files()
+        yield ('static/size=%d' % size,
+               wsgi_request(site, '/static/%s' % name))
+        yield ('static/cached,size=%d' % size,
+               wsgi_request(site, '/cached/%s' % name))
+
+    listing = os.path.join(directory, 'listing')
+    os.mkdir(listing)
+    for i in range(1000):
+        open(os.path.join(listing, 'file%04d' % i), 'w').close()
+
+    class Listing(Resource):
+        static = Static(directory)
+    yield ('static/listing,entries=1000',
+           wsgi_request(Listing(), '/static/listing'))
+
+    for count in 10, 1000:
+        items = [{'url': '/items/%d' % i, 'title': 'Item <%d>' % i}
+                 for i in range(count)]
+        yield ('template/format,items=%d' % count,
+               lambda items=items: render_format(items))
+        yield ('template/compiled,items=%d' % count,
+               lambda items=items: ''.join(LIST_TEMPLATE.stream(
+                   {'items': items}, 256)))
+
+    for chunks in 10, 1000:
+        yield ('stream/chunks=%d' % chunks,
+               wsgi_request(make_stream(chunks), '/'))
+        yield ('stream/coalesced,chunks=%d' % chunks,
+               wsgi_request(make_stream(chunks, Coalescing()), '/'))
+
+
+def run(count, only=None):
+    directory = tempfile.mkdtemp()
+    try:
+        results = {}
+        for name, request in scenarios(directory):
+            if only and only not in name:
+                continue
+            results[name] = measure(request, count)
+            report(name, results[name])
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+def report(name, result, baseline=None):
+    line = '%-32s %10.0f req/s  p50 %7.3f ms  p99 %7.3f ms  %5.1f retained' % (
+        name, result['requests_per_sec'], result['p50_ms'], result['p99_ms'],
+        result['retained'])
+    if result['peak_bytes'] is not None:
+        line += '  %8d peak bytes' % result['peak_bytes']
+    if baseline is not None:
+        line += '  (%.2fx)' % (result['requests_per_sec'] /
+                               baseline['requests_per_sec'])
+    print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--requests', type=int, default=2000,
+                        help='requests per scenario')
+    parser.add_argument('-k', '--only', help='only run matching scenarios')
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    parser.add_argument('-c', '--compare',
+                        help='compare with results from an earlier run')
+    args = parser.parse_args(argv)
+
+    results = run(args.requests, args.only)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'implementation': platform.python_implementation(),
+                       'platform': platform.platform(),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'results': results},
+                      f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print('\nCompared with %s:' % args.compare)
+        for name in sorted(results):
+            if name in baseline:
+                report(name, results[name], baseline[name])
+
+
+if __name__ == '__main__':
+    main()
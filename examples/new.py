@@ -1,9 +1,15 @@
+from threading import Thread
 from time import sleep
 
 from gevent.wsgi import WSGIServer
 from cherrypy.wsgiserver import CherryPyWSGIServer
 
-from sinpy import Resource
+from sinpy import Dispatcher, Resource, Stream, StreamClosed, Template
+
+dispatcher = Dispatcher()
+
+items_template = Template('<ul>{% for item in items %}<li>{{ item }}</li>'
+                          '{% endfor %}<li>Bye</li></ul>', batch=1)
 
 
 class Site(Resource):
@@ -15,12 +21,30 @@ class Site(Resource):
     def iter(self):
         self.response.headers['Content-type'] = 'text/html'
 
-        yield '<ul>'
-        for i in 'One', 'Two', 'Three', 'Boom!':
-            yield '<li>%s</li>' % i
-            sleep(1)
-        yield '<li>Bye</li>'
-        yield '</ul>'
+        def items():
+            for i in 'One', 'Two', 'Three', 'Boom!':
+                yield i
+                sleep(1)
+
+        return items_template.stream({'items': items()})
+
+    @Resource
+    def events(self):
+        self.response.headers['Content-type'] = 'text/event-stream'
+        stream = Stream(max_buffer=4)
+
+        def produce():
+            try:
+                for i in range(10):
+                    stream.put('data: %d\n\n' % i)
+                    sleep(1)
+            except StreamClosed:
+                pass
+            finally:
+                stream.finish()
+
+        Thread(target=produce).start()
+        return stream
 
     @Resource()
     def list(self):
@@ -44,9 +68,16 @@ class Site(Resource):
     def sublevel1(self):
         return 'Hej'
 
+    @dispatcher.route('contact/<int:id_>')
+    @Resource
+    def contact(self, id_):
+        return 'Contact #%d' % id_
+
     string = 'Hello'
     list_ = ['1\n', '2\n', '3\n']
 
 if __name__ == '__main__':
     WSGIServer(('', 8080), Site()).serve_forever()
     # CherryPyWSGIServer(('0.0.0.0', 8080), Site()).start()
+    # from sinpy.server import PreforkServer
+    # PreforkServer(Site(), port=8080, max_requests=10000).serve_forever()
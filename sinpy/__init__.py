@@ -1,10 +1,77 @@
+from bisect import bisect_left
+from collections import deque, OrderedDict
 from copy import copy
+from email.utils import formatdate, mktime_tz, parsedate_tz
 import errno
+from heapq import heappush, heappushpop
 from mimetypes import guess_type
 import os.path
-from re import compile as re_compile
+from itertools import chain, count, islice
+from json import JSONEncoder
+from random import random
+from re import compile as re_compile, escape as re_escape
+from tempfile import SpooledTemporaryFile
 import threading
-from types import FunctionType
+from time import time
+from types import FunctionType, GeneratorType
+from uuid import UUID, uuid4
+from weakref import WeakKeyDictionary
+import zlib
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:
+    from inspect import getargspec
+
+try:
+    from time import monotonic
+except ImportError:
+    from timeit import default_timer as monotonic
+
+try:
+    from http.client import responses
+except ImportError:
+    from httplib import responses
+
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    class ContextVar(object):
+        """Fallback for Pythons without contextvars, backed by
+        threading.local (greenlet-local once gevent has monkey patched it).
+        """
+
+        def __init__(self, name, default=None):
+            self.name = name
+            self._default = default
+            self._local = threading.local()
+
+        def get(self):
+            return getattr(self._local, 'value', self._default)
+
+        def set(self, value):
+            self._local.value = value
+
+
+from sinpy.template import escape, Markup, Template, TemplateError, Templates
 
 
 class get_response(object):
@@ -12,173 +79,2106 @@ class get_response(object):
         if not path:
             return None, None
 
-        parts = path.split('/', 1)
+        parts = path.split('/', 1)
+
+        if len(parts) == 2:
+            return tuple(parts)
+        else:
+            return parts[0], None
+
+    def __call__(self, obj, method, path=None, fullpath=None, context=None):
+        if context is None:
+            context = Context()
+
+        with context:
+            return self._walk(obj, method, path, fullpath, {})
+
+    def _walk(self, obj, method, path, fullpath, params):
+        if fullpath is None:
+            fullpath = path
+
+        dispatcher = getattr(obj, '_dispatcher', _default_dispatcher)
+
+        try:
+            path = path.strip('/')
+        except AttributeError:
+            pass
+
+        if path:
+            member, ctx = dispatcher.get(obj, path)
+            if member:
+                if ctx:
+                    params = dict(params, **ctx)
+                return self._walk(member, method, None, fullpath, params)
+
+        part1, part2 = self._split_path(path)
+
+        if not part1:
+            return self.respond(obj, method, fullpath, params)
+
+        handler, ctx = dispatcher.get(obj, part1)
+        if handler is None:
+            handler = _not_found
+        elif ctx:
+            params = dict(params, **ctx)
+        return self._walk(handler, method, part2, fullpath, params)
+
+    def respond(self, obj, method, fullpath, params=None):
+        """Call the ``method`` handler of ``obj``. Route parameters in
+        ``params`` become ``request.params``, and are passed on as keyword
+        arguments to handlers taking them. Optional handler arguments that
+        are not route parameters are filled from the form or query string.
+
+        HEAD falls back to the GET handler, and OPTIONS to an empty response
+        listing the allowed methods. Other methods without a handler get a
+        405 response, and handlers missing required route parameters a 404.
+        """
+        context = _context.get()
+        if context.instrumentation is not None:
+            context.target = obj
+            context.instrument('resolve_end')
+
+        obj.request.path = fullpath
+        obj.request.params = params or {}
+        obj.response.start()
+        handler, args = _method_handler(obj, method)
+        try:
+            if handler is None:
+                self._unsupported(obj, method)
+                kwargs = {}
+            else:
+                kwargs = _handler_kwargs(handler, len(args), params or {},
+                                         obj.request)
+
+            # Handlers reached without the route parameters they require,
+            # as through the bare attribute name, have nothing to show.
+            if kwargs is None:
+                handler = None
+                obj.response.start(404, body='Not found')
+            elif kwargs:
+                obj.response.body = handler(*args, **kwargs)
+            elif handler is not None:
+                obj.response.body = handler(*args)
+        except RequestTooLarge:
+            obj.response.start(413, body='Request entity too large')
+        else:
+            if handler is not None:
+                self._set_cache_ttl(obj, handler)
+
+        if context.instrumentation is not None:
+            context.instrument('handler_end')
+        return obj.response
+
+    def _unsupported(self, obj, method):
+        if isinstance(obj, NotFound):
+            obj.response.body = obj.get()
+            return
+
+        allowed = ', '.join(_allowed_methods(obj))
+        if method == 'OPTIONS':
+            obj.response.start(204, headers=[], body=[])
+        else:
+            obj.response.start(405, body='Method not allowed')
+        obj.response.headers['Allow'] = allowed
+
+    def _set_cache_ttl(self, obj, member):
+        ttl = getattr(member, '_sp_cache_ttl', None)
+        if ttl is None:
+            ttl = getattr(obj, '_sp_cache_ttl', None)
+        if ttl is not None:
+            obj.response.headers.setdefault('Cache-Control', 'max-age=%d' % ttl)
+get_response = get_response()
+
+
+_STATUS_LINES = dict((code, '%d %s' % (code, reason.upper()))
+                     for code, reason in responses.items())
+
+
+class Headers(object):
+    """Ordered, case-insensitive collection of response headers.
+
+    A name may occur several times, as Set-Cookie does; ``add`` appends a
+    value while item assignment replaces all of them. ``items`` returns the
+    underlying list of (name, value) pairs, ready to pass to start_response.
+    """
+    __slots__ = ('_items',)
+
+    def __init__(self, headers=None):
+        self._items = []
+        if headers is not None:
+            self.update(headers)
+
+    def _find(self, name):
+        name = name.lower()
+        return [i for i, (key, _) in enumerate(self._items)
+                if key.lower() == name]
+
+    def __getitem__(self, name):
+        name = name.lower()
+        for key, value in self._items:
+            if key.lower() == name:
+                return value
+        raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        del self[name]
+        self.add(name, value)
+
+    def __delitem__(self, name):
+        for i in reversed(self._find(name)):
+            del self._items[i]
+
+    def __contains__(self, name):
+        name = name.lower()
+        return any(key.lower() == name for key, _ in self._items)
+
+    def __iter__(self):
+        return (key for key, _ in self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __eq__(self, other):
+        if not isinstance(other, Headers):
+            try:
+                other = Headers(other)
+            except (AttributeError, TypeError, ValueError):
+                return NotImplemented
+        return (sorted((key.lower(), value) for key, value in self._items) ==
+                sorted((key.lower(), value) for key, value in other._items))
+
+    def __ne__(self, other):
+        equal = self == other
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Headers(%r)' % self._items
+
+    def add(self, name, value):
+        """Add a value for ``name``, keeping any existing ones. A value of
+        None adds nothing.
+        """
+        if value is not None:
+            if not isinstance(value, str):
+                value = str(value)
+            self._items.append((name, value))
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def get_all(self, name):
+        name = name.lower()
+        return [value for key, value in self._items if key.lower() == name]
+
+    def pop(self, name, *default):
+        try:
+            value = self[name]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[name]
+        return value
+
+    def setdefault(self, name, value):
+        if name not in self:
+            self.add(name, value)
+        return self.get(name)
+
+    def update(self, headers):
+        if hasattr(headers, 'items'):
+            headers = headers.items()
+        for name, value in headers:
+            self[name] = value
+
+    def items(self):
+        return self._items
+
+    def keys(self):
+        return [key for key, _ in self._items]
+
+
+class Response(object):
+    __slots__ = ('status_code', '_headers', '_body')
+
+    def __init__(self, status_code=200, headers=None, body=None):
+        self.start(status_code, headers, body)
+
+    def start(self, status_code=200, headers=None, body=None):
+        if headers is None:
+            headers = [('Content-type', 'text/plain')]
+
+        self.status_code = status_code
+        self.headers = headers
+        self._body = body
+
+    @property
+    def headers(self):
+        return self._headers
+
+    @headers.setter
+    def headers(self, value):
+        self._headers = value if isinstance(value, Headers) else Headers(value)
+
+    @property
+    def headers_list(self):
+        return self._headers.items()
+
+    @property
+    def status(self):
+        try:
+            return _STATUS_LINES[self.status_code]
+        except KeyError:
+            return '%d UNKNOWN' % self.status_code
+
+    @property
+    def body(self):
+        if (hasattr(self._body, '__iter__') and
+                not isinstance(self._body, (bytes, str))):
+            return self._body
+        else:
+            return [self._body]
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+
+    def set_content_length(self, body):
+        """Set Content-Length for a list or tuple body of strings if no
+        length was given. Responses that must not have a body are left alone.
+        """
+        if ('Content-Length' in self._headers or
+                not isinstance(body, (list, tuple)) or
+                self.status_code in (204, 304) or self.status_code < 200):
+            return
+
+        try:
+            length = sum(len(part) for part in body)
+        except TypeError:
+            return
+        self._headers.add('Content-Length', str(length))
+
+
+FLUSH = object()
+
+
+def _accepts_encoding(environ, coding):
+    qualities = {}
+    for part in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = part.partition(';')
+        params = params.strip()
+        try:
+            quality = float(params[2:]) if params.startswith('q=') else 1.0
+        except ValueError:
+            quality = 0.0
+        qualities[name.strip().lower()] = quality
+
+    return qualities.get(coding, qualities.get('*', 0.0)) > 0
+
+
+class Compression(object):
+    """Gzip generated response bodies for clients that accept it.
+
+    Set an instance as ``_compression`` on the Resource used as the WSGI
+    application. Bodies are compressed chunk by chunk as they are streamed.
+    Only 200 responses whose Content-type matches ``content_types`` are
+    compressed, and only once at least ``min_size`` bytes are known to
+    follow. Up to ``min_size`` bytes are buffered to decide that, unless
+    the body yields FLUSH first.
+    """
+    CONTENT_TYPES = ('text/', 'application/javascript', 'application/json',
+                     'application/xml', 'image/svg+xml')
+
+    def __init__(self, min_size=1024, content_types=CONTENT_TYPES, level=6):
+        self.min_size = min_size
+        self.content_types = tuple(content_types)
+        self.level = level
+
+    def __call__(self, environ, response, body):
+        if not _accepts_encoding(environ, 'gzip'):
+            return body
+
+        original = body
+        body = iter(body)
+        buffered = []
+        size = 0
+        for chunk in body:
+            buffered.append(chunk)
+            if chunk is FLUSH:
+                break
+            size += len(chunk or '')
+            if size >= self.min_size:
+                break
+
+        headers = response.headers
+        if 'Content-Length' in headers:
+            size = int(headers['Content-Length'])
+        elif buffered and buffered[-1] is FLUSH:
+            size = self.min_size
+
+        if (size < self.min_size or response.status_code != 200 or
+                'Content-Encoding' in headers or
+                'Content-Range' in headers or
+                not self._compressible(headers.get('Content-type'))):
+            # Lists stay lists, so that they still get a Content-Length.
+            if isinstance(original, (list, tuple)):
+                return original
+            return chain(buffered, body)
+
+        headers['Content-Encoding'] = 'gzip'
+        headers.pop('Content-Length', None)
+        if headers.get('Vary'):
+            headers['Vary'] += ', Accept-Encoding'
+        else:
+            headers['Vary'] = 'Accept-Encoding'
+        if 'ETag' in headers and not headers['ETag'].startswith('W/'):
+            headers['ETag'] = 'W/' + headers['ETag']
+
+        return self._compress(chain(buffered, body))
+
+    def _compressible(self, content_type):
+        if not content_type:
+            return False
+
+        content_type = content_type.split(';', 1)[0].strip().lower()
+        return any(content_type == allowed or
+                   allowed.endswith('/') and content_type.startswith(allowed)
+                   for allowed in self.content_types)
+
+    def _compress(self, chunks):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            if chunk is FLUSH:
+                data = compressor.flush(zlib.Z_SYNC_FLUSH)
+                if data:
+                    yield data
+                yield FLUSH
+                continue
+            if not chunk:
+                continue
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode('utf-8')
+
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+class Coalescing(object):
+    """Join the small chunks of generated response bodies.
+
+    Set an instance as ``_coalescing`` on the Resource used as the WSGI
+    application. Chunks are buffered until ``max_bytes`` are collected or
+    the oldest buffered chunk is ``max_delay`` seconds old. The delay is
+    only checked when the next chunk arrives, so handlers that stream with
+    pauses should yield FLUSH to send what they have right away.
+    """
+
+    def __init__(self, max_bytes=8192, max_delay=0.2):
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+    def __call__(self, body):
+        buffered = []
+        size = 0
+        started = None
+        for chunk in body:
+            if chunk is FLUSH:
+                if buffered:
+                    yield self._join(buffered)
+                    buffered, size = [], 0
+                continue
+            if not chunk:
+                continue
+
+            buffered.append(chunk)
+            size += len(chunk)
+            if len(buffered) == 1:
+                started = time()
+
+            if size >= self.max_bytes or time() - started >= self.max_delay:
+                yield self._join(buffered)
+                buffered, size = [], 0
+
+        if buffered:
+            yield self._join(buffered)
+
+    def _join(self, chunks):
+        if len(chunks) == 1:
+            return chunks[0]
+        elif isinstance(chunks[0], bytes):
+            return b''.join(chunks)
+        else:
+            return ''.join(chunks)
+
+
+class _Limit(object):
+    __slots__ = ('prefix', 'limit', 'in_flight')
+
+    def __init__(self, prefix, limit):
+        self.prefix = prefix
+        self.limit = limit
+        self.in_flight = 0
+
+    def __repr__(self):
+        return '<_Limit %r %d/%s>' % (self.prefix, self.in_flight, self.limit)
+
+
+class AdmissionControl(object):
+    """Cap the requests a Resource serves at once, answering the rest with
+    a precomputed 503 and Retry-After instead of queueing them.
+
+    Set an instance as ``_admission`` on the Resource used as the WSGI
+    application. At most ``max_in_flight`` requests are served at once, and
+    at most ``prefixes[prefix]`` of those with paths under that prefix; the
+    longest matching prefix applies. A request arriving while its limits
+    are reached waits up to ``max_wait`` seconds for a slot. Requests hold
+    their slots until their body is closed.
+
+    Once the smoothed time from arrival to response, queueing included,
+    exceeds ``latency_target`` seconds, requests no longer wait: those that
+    cannot be served right away are rejected until latency recovers. A
+    latency target therefore needs ``max_in_flight`` or ``prefixes``.
+    """
+    _SMOOTHING = 0.2
+
+    def __init__(self, max_in_flight=None, prefixes=None, max_wait=0.1,
+                 latency_target=None, retry_after=1):
+        if latency_target is not None and max_in_flight is None and \
+                not prefixes:
+            raise ValueError('latency_target needs max_in_flight or '
+                             'prefixes to shed requests')
+
+        self.max_wait = max_wait
+        self.latency_target = latency_target
+        self.retry_after = retry_after
+
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.latency = 0.0
+
+        self._global = _Limit('', max_in_flight)
+        self._prefixes = sorted((_Limit(prefix, limit) for prefix, limit
+                                 in (prefixes or {}).items()),
+                                key=lambda limit: -len(limit.prefix))
+        self._condition = threading.Condition(threading.Lock())
+
+        body = b'Service unavailable, retry later'
+        self._status = _STATUS_LINES[503]
+        self._headers = [('Content-type', 'text/plain'),
+                         ('Content-Length', str(len(body))),
+                         ('Retry-After', str(retry_after))]
+        self._body = [body]
+
+    @property
+    def in_flight(self):
+        return self._global.in_flight
+
+    def counters(self):
+        """Return a snapshot of the live counters."""
+        with self._condition:
+            return {'in_flight': self._global.in_flight,
+                    'queued': self.queued,
+                    'admitted': self.admitted,
+                    'rejected': self.rejected,
+                    'wait_time': self.wait_time,
+                    'latency': self.latency,
+                    'prefixes': dict((limit.prefix, limit.in_flight)
+                                     for limit in self._prefixes)}
+
+    def acquire(self, path):
+        """Take the slots for a request to path, waiting if allowed. Return
+        a ticket to pass to ``release``, or None if the request is shed.
+        """
+        arrived = monotonic()
+        limits = [self._global]
+        for limit in self._prefixes:
+            if path.startswith(limit.prefix):
+                limits.append(limit)
+                break
+
+        with self._condition:
+            if not self._available(limits):
+                if (self.latency_target is not None and
+                        self.latency > self.latency_target):
+                    self.rejected += 1
+                    return None
+
+                deadline = arrived + self.max_wait
+                self.queued += 1
+                try:
+                    while not self._available(limits):
+                        remaining = deadline - monotonic()
+                        if remaining <= 0:
+                            self.rejected += 1
+                            return None
+                        self._condition.wait(remaining)
+                finally:
+                    self.queued -= 1
+                self.wait_time += monotonic() - arrived
+
+            for limit in limits:
+                limit.in_flight += 1
+            self.admitted += 1
+        return limits, arrived
+
+    def _available(self, limits):
+        return all(limit.limit is None or limit.in_flight < limit.limit
+                   for limit in limits)
+
+    def record(self, ticket):
+        """Count the time since the request of ticket arrived toward the
+        smoothed latency.
+        """
+        latency = monotonic() - ticket[1]
+        with self._condition:
+            self.latency += (latency - self.latency) * self._SMOOTHING
+
+    def release(self, ticket):
+        with self._condition:
+            for limit in ticket[0]:
+                limit.in_flight -= 1
+            self._condition.notify_all()
+
+    def reject(self, start_response):
+        start_response(self._status, list(self._headers))
+        return self._body
+
+    def closing(self, body, ticket, file_wrapper=None):
+        """Wrap body so that ticket is released when the server closes it,
+        whether or not the body was iterated.
+
+        Instances of the server's ``file_wrapper`` are returned as they are,
+        with a ``close`` that also releases the ticket, so that the server
+        still recognizes them and can send the file directly.
+        """
+        admitted = _AdmittedBody(body, self, ticket)
+        try:
+            # file_wrapper may be any callable, or an old-style class.
+            wrapped = (file_wrapper is not None and
+                       isinstance(body, file_wrapper))
+        except TypeError:
+            wrapped = False
+        if wrapped:
+            try:
+                body.close = admitted.close
+                return body
+            except AttributeError:
+                pass
+        return admitted
+
+
+class _AdmittedBody(object):
+    __slots__ = ('_body', '_close', '_admission', '_ticket')
+
+    def __init__(self, body, admission, ticket):
+        self._body = body
+        self._close = getattr(body, 'close', None)
+        self._admission = admission
+        self._ticket = ticket
+
+    def __iter__(self):
+        return iter(self._body)
+
+    def close(self):
+        ticket, self._ticket = self._ticket, None
+        try:
+            if ticket is not None and self._close is not None:
+                self._close()
+        finally:
+            if ticket is not None:
+                self._admission.release(ticket)
+
+
+class StreamClosed(IOError):
+    """Raised to producers of a Stream that was closed by the server."""
+
+
+_EMPTY = object()
+
+
+class Stream(object):
+    """Response body fed by a generator, an async generator or producers.
+
+    Without a ``source``, producers in other threads ``put`` chunks and
+    call ``finish``, in a finally clause, when done. At most ``max_buffer``
+    chunks are buffered. Beyond that ``put`` blocks until the server has
+    taken one, so a slow client throttles its producers instead of growing
+    memory.
+
+    Generators are pulled as the server sends, inside the request's
+    Context. Under ASGI, streams are read asynchronously: waiting for
+    producers holds no thread, and async generators are iterated on the
+    server's event loop. WSGI servers get async generators through an
+    event loop in a thread of their own, which feeds the buffer like a
+    producer.
+
+    When the server closes the stream before it is exhausted, typically
+    because the client went away, the source is closed, ``put`` raises
+    StreamClosed and ``on_cancel`` is called with the stream. FLUSH chunks
+    are dropped, since the server sends each chunk as it comes.
+    """
+
+    def __init__(self, source=None, max_buffer=16, on_cancel=None):
+        self.source = source
+        self.max_buffer = max_buffer
+        self.on_cancel = on_cancel
+        self.closed = False
+        self._finished = False
+        self._buffer = deque()
+        self._condition = threading.Condition()
+        self._context = Context.current()
+        self._iterator = None
+        self._feeding = False
+        self._listeners = []
+
+        if source is not None and not hasattr(source, '__aiter__'):
+            self._iterator = iter(source)
+
+    def _feed(self, source):
+        from sinpy.asgi import feed_stream
+        _context.set(self._context)
+        feed_stream(self, source)
+
+    def put(self, chunk):
+        with self._condition:
+            while len(self._buffer) >= self.max_buffer and not self.closed:
+                self._condition.wait()
+            if self.closed:
+                raise StreamClosed('Stream closed')
+            self._buffer.append(chunk)
+            self._notify()
+
+    def finish(self):
+        with self._condition:
+            self._finished = True
+            self._notify()
+
+    def _notify(self):
+        self._condition.notify_all()
+        for listener in self._listeners:
+            listener()
+
+    def __iter__(self):
+        return self
+
+    def __aiter__(self):
+        from sinpy.asgi import iter_stream
+        return iter_stream(self)
+
+    def __next__(self):
+        if self.source is not None and self._iterator is None:
+            self._start_feed()
+        while True:
+            if self._iterator is not None:
+                chunk = self._pull()
+            else:
+                chunk = self._get()
+            if chunk is not FLUSH:
+                return chunk
+    next = __next__
+
+    def _pull(self):
+        try:
+            if self._context is None:
+                return next(self._iterator)
+            with self._context:
+                return next(self._iterator)
+        except StopIteration:
+            self._finished = True
+            raise
+
+    def _start_feed(self):
+        with self._condition:
+            if self._feeding:
+                return
+            self._feeding = True
+        thread = threading.Thread(target=self._feed, args=(self.source,))
+        thread.daemon = True
+        thread.start()
+
+    def _get(self, block=True):
+        """Take the next buffered chunk. Without ``block``, return
+        _EMPTY instead of waiting for one.
+        """
+        with self._condition:
+            while not self._buffer:
+                if self._finished or self.closed:
+                    raise StopIteration
+                if not block:
+                    return _EMPTY
+                self._condition.wait()
+            chunk = self._buffer.popleft()
+            self._condition.notify_all()
+            return chunk
+
+    def close(self):
+        with self._condition:
+            if self.closed:
+                return
+            self.closed = True
+            cancelled = not self._finished or bool(self._buffer)
+            self._buffer.clear()
+            self._notify()
+
+        if hasattr(self._iterator, 'close'):
+            self._iterator.close()
+        if cancelled and self.on_cancel is not None:
+            self.on_cancel(self)
+
+
+_JSON_BATCH_SIZE = 1000
+
+
+def json_body(data, ndjson=False, default=None, batch_size=_JSON_BATCH_SIZE):
+    """Return data serialized as JSON, for handlers to return as body, and
+    set the Content-type of the current response.
+
+    Dicts and other values that are not lists, tuples or iterators are
+    encoded at once. The records of anything else are encoded
+    ``batch_size`` at a time and sent as they are, as a JSON array, or as
+    newline delimited JSON with ``ndjson``. Generators of records are
+    therefore streamed in constant memory. ``default`` is passed on to
+    the JSON encoder, for values it can't serialize itself.
+    """
+    encode = JSONEncoder(separators=(',', ':'), default=default).encode
+    context = _context.get()
+    if context is not None:
+        context.response.headers['Content-type'] = (
+            'application/x-ndjson' if ndjson else 'application/json')
+
+    if (isinstance(data, (list, tuple)) or hasattr(data, '__next__') or
+            hasattr(data, 'next')):
+        return _iter_json(data, encode, ndjson, batch_size)
+    return [encode(data) + '\n' if ndjson else encode(data)]
+
+
+def _iter_json(records, encode, ndjson, batch_size):
+    iterator = iter(records)
+    separator = '\n' if ndjson else ','
+    started = False
+    try:
+        while True:
+            batch = [encode(record) for record in islice(iterator, batch_size)]
+            if not batch:
+                break
+            chunk = separator.join(batch)
+            if ndjson:
+                yield chunk + '\n'
+            else:
+                yield (',' if started else '[') + chunk
+            started = True
+    finally:
+        if hasattr(records, 'close'):
+            records.close()
+
+    if not ndjson:
+        yield ']' if started else '[]'
+
+
+class SubrequestTimeout(Exception):
+    """Set as the ``error`` of subrequests that did not finish in time."""
+
+
+class Subrequest(object):
+    """One internal request made through Subrequests.
+
+    Once done, ``response`` holds its Response, with the whole body read
+    into ``body``, or ``error`` the exception it failed with.
+    """
+
+    def __init__(self, path, method='GET', timeout=None):
+        self.path = path
+        self.method = method
+        self.timeout = timeout
+        self.response = None
+        self.body = None
+        self.error = None
+        self.elapsed = None
+
+    @property
+    def status_code(self):
+        return self.response.status_code if self.response else None
+
+    def __repr__(self):
+        return '<Subrequest %s %s %s>' % (self.method, self.path,
+                                          self.status_code or self.error)
+
+
+class Subrequests(object):
+    """Answer internal requests to a Resource tree on a thread pool.
+
+    Each subrequest runs get_response in a Context of its own, with the
+    headers and server variables of the current request, if any, but not
+    its body. Bodies are read in the worker thread, inside that context.
+
+    ``run`` yields subrequests as they complete, so the slowest one bounds
+    the total time. Subrequests still running ``timeout`` seconds after
+    they were queued are given up on, with a SubrequestTimeout error. Their
+    threads can't be interrupted though, and keep a worker busy until the
+    handler returns.
+    """
+
+    def __init__(self, root, max_workers=8, timeout=None):
+        self.root = root
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._tasks = Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def get(self, path, timeout=None):
+        """Return the finished Subrequest for a single GET of path."""
+        return next(self.run([Subrequest(path, timeout=timeout)]))
+
+    def run(self, requests):
+        """Start requests, paths or Subrequests, and yield them as they
+        complete.
+        """
+        requests = [request if isinstance(request, Subrequest)
+                    else Subrequest(request) for request in requests]
+        environ = self._environ()
+        results = Queue()
+        deadlines = {}
+        now = monotonic()
+        for request in requests:
+            timeout = request.timeout
+            if timeout is None:
+                timeout = self.timeout
+            deadlines[request] = now + timeout if timeout is not None else None
+            self._submit((request, environ, results))
+
+        while deadlines:
+            pending = [deadline for deadline in deadlines.values()
+                       if deadline is not None]
+            try:
+                if pending:
+                    request = results.get(
+                        timeout=max(min(pending) - monotonic(), 0))
+                else:
+                    request = results.get()
+            except Empty:
+                now = monotonic()
+                for request, deadline in list(deadlines.items()):
+                    if deadline is not None and deadline <= now:
+                        del deadlines[request]
+                        request.error = SubrequestTimeout(request.path)
+                        yield request
+                continue
+            if deadlines.pop(request, False) is not False:
+                yield request
+
+    def _environ(self):
+        context = _context.get()
+        if context is None:
+            return {}
+        return dict((key, value)
+                    for key, value in context.request.environ.items()
+                    if key.startswith(('HTTP_', 'SERVER_', 'REMOTE_')) or
+                    key in ('SCRIPT_NAME', 'wsgi.url_scheme'))
+
+    def _submit(self, task):
+        self._tasks.put(task)
+        with self._lock:
+            if len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            request, environ, results = self._tasks.get()
+            self._respond(request, environ)
+            results.put(request)
+
+    def _respond(self, request, environ):
+        path, _, query = request.path.partition('?')
+        environ = dict(environ, REQUEST_METHOD=request.method,
+                       PATH_INFO=path, QUERY_STRING=query)
+        context = Context(Request(environ))
+        started = monotonic()
+        try:
+            response = get_response(self.root, request.method, path,
+                                    context=context)
+            with context:
+                body = response.body
+                try:
+                    parts = [part for part in body
+                             if part is not FLUSH and part is not None]
+                finally:
+                    if hasattr(body, 'close'):
+                        body.close()
+            if all(isinstance(part, bytes) for part in parts):
+                request.body = b''.join(parts)
+            else:
+                request.body = ''.join(
+                    part.decode('utf-8') if isinstance(part, bytes) else part
+                    for part in parts)
+            request.response = response
+        except Exception as e:
+            request.error = e
+        request.elapsed = monotonic() - started
+
+
+class RequestTooLarge(ValueError):
+    pass
+
+
+class _lazy(object):
+    """Compute an attribute on first access and store it on the instance."""
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.func.__name__] = self.func(obj)
+        return value
+
+
+class Request(object):
+    """The request, parsed from the WSGI environ on demand.
+
+    Nothing is parsed until it is first used, and the result is kept for
+    the rest of the request.
+    """
+    _MAX_BODY_SIZE = 10 * 1024 * 1024
+    _SPOOL_SIZE = 512 * 1024
+    _BLOCK_SIZE = 64 * 1024
+    params = {}
+
+    def __init__(self, environ=None):
+        self.environ = environ if environ is not None else {}
+        self.path = self.environ.get('PATH_INFO', '')
+
+    @property
+    def method(self):
+        return self.environ.get('REQUEST_METHOD', 'GET')
+
+    @_lazy
+    def headers(self):
+        headers = Headers()
+        for key, value in self.environ.items():
+            if key.startswith('HTTP_'):
+                name = key[5:]
+            elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH') and value:
+                name = key
+            else:
+                continue
+            headers.add('-'.join(part.capitalize()
+                                 for part in name.split('_')), value)
+        return headers
+
+    @_lazy
+    def query(self):
+        """Query string parameters, as a dict of lists of values."""
+        return parse_qs(self.environ.get('QUERY_STRING', ''),
+                        keep_blank_values=True)
+
+    @_lazy
+    def cookies(self):
+        cookies = {}
+        for part in self.environ.get('HTTP_COOKIE', '').split(';'):
+            name, _, value = part.partition('=')
+            name = name.strip()
+            if name:
+                cookies.setdefault(name, value.strip().strip('"'))
+        return cookies
+
+    @_lazy
+    def body(self):
+        """The request body as a file object, read from wsgi.input.
+
+        Bodies larger than _SPOOL_SIZE are kept in a temporary file, and
+        bodies larger than _MAX_BODY_SIZE raise RequestTooLarge, which is
+        answered with a 413.
+        """
+        stream = self.environ.get('wsgi.input')
+        try:
+            remaining = int(self.environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            remaining = 0
+
+        if remaining > self._MAX_BODY_SIZE:
+            raise RequestTooLarge(remaining)
+
+        body = SpooledTemporaryFile(max_size=self._SPOOL_SIZE)
+        if stream is not None and (remaining or
+                                   self.environ.get('wsgi.input_terminated')):
+            limit = remaining or self._MAX_BODY_SIZE + 1
+            while limit > 0:
+                block = stream.read(min(self._BLOCK_SIZE, limit))
+                if not block:
+                    break
+                body.write(block)
+                limit -= len(block)
+
+            size = body.tell()
+            if not remaining and size > self._MAX_BODY_SIZE:
+                body.close()
+                raise RequestTooLarge(size)
+
+        body.seek(0)
+        return body
+
+    def argument(self, name):
+        """Return the first value of the form field or, failing that, the
+        query string parameter ``name``, or None if there is neither.
+        """
+        values = self.form.get(name) or self.query.get(name)
+        return values[0] if values else None
+
+    @_lazy
+    def form(self):
+        """Form fields of urlencoded or multipart bodies, as a dict of lists.
+
+        Uploaded files are kept as cgi.FieldStorage objects.
+        """
+        content_type = self.environ.get('CONTENT_TYPE', '')
+        mime_type = content_type.split(';', 1)[0].strip().lower()
+
+        if mime_type == 'application/x-www-form-urlencoded':
+            data = self.body.read()
+            self.body.seek(0)
+            if not isinstance(data, str):
+                data = data.decode('utf-8')
+            return parse_qs(data, keep_blank_values=True)
+
+        if mime_type == 'multipart/form-data':
+            try:
+                from cgi import FieldStorage
+            except ImportError:
+                return {}
+
+            fields = FieldStorage(
+                fp=self.body,
+                environ={'REQUEST_METHOD': 'POST',
+                         'CONTENT_TYPE': content_type,
+                         'CONTENT_LENGTH': self.environ.get('CONTENT_LENGTH',
+                                                            '')},
+                keep_blank_values=True)
+            form = {}
+            for field in fields.list or []:
+                form.setdefault(field.name, []).append(
+                    field if field.filename else field.value)
+            return form
+
+        return {}
+
+
+_context = ContextVar('sinpy.context', default=None)
+
+
+class Context(object):
+    """State of one request: its Request and Response.
+
+    Entering a context makes it the current one, which is what
+    ``Resource.request`` and ``Resource.response`` refer to.
+
+    With ``instrumentation`` set, the context also keeps the monotonic time
+    of each request event in ``timings`` and the Resource that responded in
+    ``target``; see Instrumentation.
+    """
+    target = None
+
+    def __init__(self, request=None, response=None, instrumentation=None):
+        self.request = request if request is not None else Request()
+        self.response = response if response is not None else Response()
+        self.instrumentation = instrumentation
+        self.timings = {} if instrumentation is not None else None
+        self._previous = []
+
+    @staticmethod
+    def current():
+        return _context.get()
+
+    def __enter__(self):
+        self._previous.append(_context.get())
+        _context.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _context.set(self._previous.pop())
+
+    def instrument(self, event):
+        timestamp = self.timings[event] = monotonic()
+        getattr(self.instrumentation, event)(self, timestamp)
+
+
+class _ResourceType(type):
+    def __setattr__(cls, name, value):
+        super(_ResourceType, cls).__setattr__(name, value)
+        Dispatcher.invalidate()
+
+    def __delattr__(cls, name):
+        super(_ResourceType, cls).__delattr__(name)
+        Dispatcher.invalidate()
+
+
+class Resource(_ResourceType('_ResourceBase', (object,), {})):
+    _compression = None
+    _coalescing = None
+    _instrumentation = None
+    _admission = None
+
+    def __init__(self, fget=None, fpost=None, fput=None, fdelete=None,
+                 obj=None, custom_routes=None):
+        self._sp_context = Context()
+        self._fget = fget
+        self._fpost = fpost
+        self._fput = fput
+        self._fdelete = fdelete
+        if obj:
+            self._obj = obj
+
+        if custom_routes:
+            self._sp_custom_routes = custom_routes
+        else:
+            self._sp_custom_routes = []
+
+    def __get__(self, obj, objtype):
+        if obj is None or self._fget is None:
+            return self
+        else:
+            return _BoundResource(self, obj)
+
+    def _context(self):
+        return _context.get() or self._sp_context
+
+    @property
+    def request(self):
+        return self._context().request
+
+    @request.setter
+    def request(self, value):
+        self._context().request = value
+
+    @property
+    def response(self):
+        return self._context().response
+
+    @response.setter
+    def response(self, value):
+        self._context().response = value
+
+    def get(self, *args, **kwargs):
+        return self._fget(self._obj, *args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        if len(args) == 1 and type(args[0]) is FunctionType:
+            return type(self)(self._fget, args[0], self._fput, self._fdelete)
+        else:
+            return self._fpost(self._obj, *args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        if len(args) == 1 and type(args[0]) is FunctionType:
+            return type(self)(self._fget, self._fpost, args[0], self._fdelete)
+        else:
+            return self._fput(self._obj, *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        if len(args) == 1 and type(args[0]) is FunctionType:
+            return type(self)(self._fget, self._fpost, self._fput, args[0])
+        else:
+            return self._fdelete(self._obj, *args, **kwargs)
+
+    def __call__(self, *args):
+        def stream(context, body, start_response, environ, head):
+            with context:
+                try:
+                    try:
+                        # Compression may read the first parts right away.
+                        if self._compression is not None:
+                            body = self._compression(environ,
+                                                     context.response, body)
+                        if self._coalescing is not None:
+                            body = self._coalescing(body)
+                        else:
+                            body = (part for part in body if part is not FLUSH)
+                        first_part = next(body)
+                    except StopIteration:
+                        start_response(context.response.status,
+                                       context.response.headers_list)
+                        if context.instrumentation is not None:
+                            context.instrument('first_byte')
+                    except RequestTooLarge:
+                        # Generators only read request.body once iterated.
+                        response = context.response
+                        response.start(413, body='Request entity too large')
+                        response.set_content_length(response.body)
+                        start_response(response.status, response.headers_list)
+                        if context.instrumentation is not None:
+                            context.instrument('first_byte')
+                        if not head:
+                            for part in response.body:
+                                yield part
+                        return
+                    else:
+                        start_response(context.response.status,
+                                       context.response.headers_list)
+                        if context.instrumentation is not None:
+                            context.instrument('first_byte')
+                        if head:
+                            body.close()
+                            return
+                        yield first_part
+
+                    for part in body:
+                        yield part
+                finally:
+                    if context.instrumentation is not None:
+                        context.instrument('last_byte')
+
+        def application(environ, start_response):
+            admission = self._admission
+            if admission is None:
+                return serve(environ, start_response)
+
+            ticket = admission.acquire(environ['PATH_INFO'])
+            if ticket is None:
+                return admission.reject(start_response)
+            try:
+                body = serve(environ, start_response)
+            except BaseException:
+                admission.release(ticket)
+                raise
+            admission.record(ticket)
+
+            # Anything but a finished list, like generators, Streams and
+            # wsgi.file_wrapper objects, keeps its slots until it is closed.
+            if isinstance(body, (list, tuple)):
+                admission.release(ticket)
+                return body
+            return admission.closing(body, ticket,
+                                     environ.get('wsgi.file_wrapper'))
+
+        def serve(environ, start_response):
+            context = Context(Request(environ),
+                              instrumentation=self._instrumentation)
+            if context.instrumentation is not None:
+                context.instrument('resolve_start')
+            try:
+                response = get_response(self, environ['REQUEST_METHOD'],
+                                        environ['PATH_INFO'], context=context)
+            except BaseException:
+                # Hooks like SlowestProfiles must see failed requests end.
+                if context.instrumentation is not None:
+                    context.instrument('last_byte')
+                raise
+
+            # Generators may still change status and headers on their
+            # first iteration. Anything else, like wsgi.file_wrapper
+            # objects, is handed to the server untouched. Responses to
+            # HEAD keep the headers of the GET response, but no body.
+            head = environ['REQUEST_METHOD'] == 'HEAD'
+            body = response.body
+            if isinstance(body, GeneratorType):
+                return stream(context, body, start_response, environ, head)
+
+            if self._compression is not None and isinstance(body, list):
+                body = self._compression(environ, response, body)
+
+            response.set_content_length(body)
+            start_response(response.status, response.headers_list)
+            if head:
+                if hasattr(body, 'close'):
+                    body.close()
+                body = []
+            if context.instrumentation is not None:
+                context.instrument('first_byte')
+                context.instrument('last_byte')
+            return body
+
+        if len(args) == 1 and type(args[0]) is FunctionType:
+            return type(self)(args[0])
+        else:
+            return application(*args[:2])
+
+
+class _BoundResource(object):
+    """A decorated Resource bound to the object it was looked up on.
+
+    Request and response state is shared with the owner, so binding costs a
+    single small object instead of a new Resource.
+    """
+    __slots__ = ('_resource', '_obj')
+
+    def __init__(self, resource, obj):
+        self._resource = resource
+        self._obj = obj
+
+    @property
+    def request(self):
+        return self._obj.request
+
+    @property
+    def response(self):
+        return self._obj.response
+
+    def get(self, *args, **kwargs):
+        return self._resource._fget(self._obj, *args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self._resource._fpost(self._obj, *args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        return self._resource._fput(self._obj, *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._resource._fdelete(self._obj, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._resource, name)
+
+    def __eq__(self, other):
+        return (type(other) is _BoundResource and
+                self._resource is other._resource and
+                self._obj is other._obj)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self._resource), id(self._obj)))
+
+
+_METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS')
+_PROXY_HANDLERS = frozenset(cls.__dict__[method]
+                             for cls in (Resource, _BoundResource)
+                             for method in ('get', 'post', 'put', 'delete'))
+_method_tables = WeakKeyDictionary()
+_NO_ATTRIBUTES = {}
+_handler_args = WeakKeyDictionary()
+
+
+def _method_table(cls):
+    """Map the HTTP methods handled by instances of ``cls`` to the name of
+    their handler, and for the get/post/put/delete proxies of decorated
+    Resources to the attribute holding the decorated function.
+
+    Tables are built once per class, and rebuilt when routes change.
+    """
+    entry = _method_tables.get(cls)
+    if entry is not None and entry[0] == Dispatcher._generation:
+        return entry[1]
+
+    table = {}
+    for method in _METHODS:
+        name = method.lower()
+        attr = getattr(cls, name, None)
+        if attr is None or isinstance(attr, Resource) or not callable(attr):
+            continue
+        if getattr(attr, '__func__', attr) in _PROXY_HANDLERS:
+            table[method] = name, '_f' + name
+        else:
+            table[method] = name, None
+    if 'GET' in table and 'HEAD' not in table:
+        table['HEAD'] = table['GET']
+
+    _method_tables[cls] = Dispatcher._generation, table
+    return table
+
+
+def _method_handler(obj, method):
+    """Return the handler for ``method`` on ``obj`` and the positional
+    arguments to call it with, or (None, ()) if there is none.
+
+    Decorated functions are called directly with their owner, rather than
+    through the proxies doubling as decorators.
+    """
+    entry = _method_table(type(obj)).get(method)
+    name, field = entry if entry is not None else (method.lower(), None)
+
+    # Handlers assigned to instances, as in ``page.get = lambda: ...``.
+    handler = getattr(obj, '__dict__', _NO_ATTRIBUTES).get(name)
+    if callable(handler) and not isinstance(handler, Resource):
+        return handler, ()
+
+    if entry is None:
+        return None, ()
+    if field is None:
+        return getattr(obj, name), ()
+
+    func = getattr(obj, field, None)
+    if func is None:
+        return None, ()
+    return func, (obj._obj,)
+
+
+def _allowed_methods(obj):
+    return [method for method in _METHODS
+            if method == 'OPTIONS' or _method_handler(obj, method)[0]]
+
+
+def _handler_kwargs(handler, bound, params, request=None):
+    """Return the route ``params`` that ``handler`` takes, or None if it
+    requires arguments that are not among them. ``bound`` is the number of
+    positional arguments it is called with.
+
+    Handlers declaring ``**kwargs`` get all of them. Optional arguments
+    missing from ``params`` are looked up with ``request.argument``. The
+    arguments of each handler function are looked up once.
+    """
+    func = getattr(handler, '__func__', handler)
+    try:
+        signature = _handler_args[func]
+    except (KeyError, TypeError):
+        try:
+            spec = getargspec(func)
+        except TypeError:
+            return params
+        signature = (tuple(spec[0]), len(spec[0]) - len(spec[3] or ()),
+                     bool(spec[2]))
+        try:
+            _handler_args[func] = signature
+        except TypeError:
+            pass
+
+    names, required, takes_kwargs = signature
+    if func is not handler and getattr(handler, '__self__', None) is not None:
+        bound += 1
+    for name in names[bound:required]:
+        if name not in params:
+            return None
+
+    if takes_kwargs:
+        kwargs = params
+    else:
+        kwargs = dict((name, params[name]) for name in names[bound:]
+                      if name in params)
+
+    if request is not None:
+        for name in names[max(bound, required):]:
+            if name not in params:
+                value = request.argument(name)
+                if value is not None:
+                    if kwargs is params:
+                        kwargs = dict(params)
+                    kwargs[name] = value
+    return kwargs
+
+
+class NotFound(Resource):
+    def get(self):
+        self.response.status_code = 404
+        return 'Not found'
+
+    post = get
+    put = get
+    patch = get
+    delete = get
+    options = get
+
+
+_not_found = NotFound()
+
+
+def cached(ttl):
+    """Mark a Resource or handler method as cacheable for ``ttl`` seconds.
+
+    Its responses get a ``Cache-Control: max-age`` header, which is what
+    ResponseCache and other HTTP caches go by.
+    """
+    def decorator(obj):
+        getattr(obj, '__func__', obj)._sp_cache_ttl = ttl
+        return obj
+
+    return decorator
+
+
+class _CachedResponse(object):
+    __slots__ = ('status', 'headers', 'body', 'expires', 'size')
+
+    def __init__(self, status, headers, body, expires):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires = expires
+        self.size = len(body) + sum(len(name) + len(value)
+                                    for name, value in headers)
+
+
+class ResponseCache(object):
+    """WSGI middleware that keeps finished GET responses in memory.
+
+    Only 200 responses with a ``max-age`` in their Cache-Control header are
+    stored, for that many seconds; see ``cached``. Responses marked private,
+    no-store or no-cache, or setting cookies, are not. Entries are keyed on
+    path, query string and the request headers named in ``vary``, and
+    evicted least recently used first beyond ``max_entries`` or
+    ``max_bytes``. HEAD requests are answered from cached GET responses.
+
+    While one request recomputes an entry, concurrent requests for it get
+    the stale entry, or wait for the new one if there is none.
+    """
+
+    def __init__(self, application, vary=('Accept-Encoding',),
+                 max_entries=1024, max_bytes=64 * 1024 * 1024, timeout=30):
+        self.application = application
+        self.vary = tuple('HTTP_' + name.upper().replace('-', '_')
+                          for name in vary)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+
+        self.size = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return float(self.hits + self.stale_hits) / lookups if lookups else 0.0
+
+    def __call__(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD')
+        if method not in ('GET', 'HEAD'):
+            return self.application(environ, start_response)
+
+        key = ((environ.get('PATH_INFO', ''), environ.get('QUERY_STRING', '')) +
+               tuple(environ.get(name) for name in self.vary))
+
+        entry, pending, leader = self._lookup(key)
+        if entry is not None and pending is None:
+            return self._serve(entry, method, start_response)
+
+        if not leader:
+            if entry is None:
+                pending.wait(self.timeout)
+                with self._lock:
+                    entry = self._entries.get(key)
+            if entry is not None:
+                return self._serve(entry, method, start_response)
+            return self.application(environ, start_response)
+
+        if method == 'HEAD':
+            self._release(key, pending)
+            return self.application(environ, start_response)
+
+        try:
+            return self._compute(key, environ, start_response)
+        finally:
+            self._release(key, pending)
+
+    def _lookup(self, key):
+        """Return the entry for key, if any, and if it needs recomputing
+        the event to wait for and whether this request should do it.
+        """
+        now = time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                if entry.expires > now:
+                    self.hits += 1
+                    return entry, None, False
+
+            pending = self._pending.get(key)
+            if pending is not None:
+                if entry is not None:
+                    self.stale_hits += 1
+                else:
+                    self.misses += 1
+                return entry, pending, False
+
+            self.misses += 1
+            pending = self._pending[key] = threading.Event()
+            return entry, pending, True
+
+    def _release(self, key, pending):
+        with self._lock:
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+        pending.set()
+
+    def _serve(self, entry, method, start_response):
+        start_response(entry.status, list(entry.headers))
+        return [entry.body] if method == 'GET' else []
+
+    def _compute(self, key, environ, start_response):
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return start_response(status, headers, exc_info)
+
+        result = self.application(environ, capture)
+        parts = iter(result)
+        buffered = []
+        for part in parts:
+            buffered.append(part)
+            if captured:
+                break
+
+        ttl = self._ttl(*captured[:2]) if captured else None
+        if ttl is None:
+            return _closing(chain(buffered, parts), result)
+
+        try:
+            buffered.extend(parts)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+        body = b''.join(part if isinstance(part, bytes) else part.encode('utf-8')
+                        for part in buffered)
+        self._store(key, _CachedResponse(captured[0], list(captured[1]), body,
+                                         time() + ttl))
+        return [body]
 
-        if len(parts) == 2:
-            return tuple(parts)
-        else:
-            return parts[0], None
+    def _ttl(self, status, headers):
+        if not status.startswith('200'):
+            return None
 
-    def __call__(self, obj, method, path=None, fullpath=None):
-        if fullpath is None:
-            fullpath = path
+        max_age = None
+        for name, value in headers:
+            name = name.lower()
+            if name == 'set-cookie':
+                return None
+            if name == 'cache-control':
+                for directive in value.lower().split(','):
+                    directive, _, argument = directive.strip().partition('=')
+                    if directive in ('private', 'no-store', 'no-cache'):
+                        return None
+                    if directive in ('max-age', 's-maxage'):
+                        try:
+                            max_age = int(argument)
+                        except ValueError:
+                            return None
+        if max_age is not None and max_age > 0:
+            return max_age
 
-        dispatcher = getattr(obj, '_dispatcher', Dispatcher())
+    def _store(self, key, entry):
+        if entry.size > self.max_bytes:
+            return
 
-        try:
-            path = path.strip('/')
-        except AttributeError:
-            pass
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous.size
 
-        if path:
-            member, ctx = dispatcher.get(obj, path)
-            if member:
-                return get_response(member, method, None, fullpath)
+            self._entries[key] = entry
+            self.size += entry.size
 
-        part1, part2 = self._split_path(path)
+            while (len(self._entries) > self.max_entries or
+                   self.size > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions += 1
 
-        if not part1:
-            obj.request.path = fullpath
-            member, ctx = dispatcher.get(obj, method.lower(), NotFound())
-            obj.response.body = member()
-            return obj.response
 
-        handler, ctx = dispatcher.get(obj, part1, NotFound())
-        return get_response(handler, method, part2, fullpath)
-get_response = get_response()
+def _closing(iterable, result):
+    try:
+        for part in iterable:
+            yield part
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
 
 
-class Response(object):
-    def __init__(self, status_code=200, headers=None, body=None):
-        self.start(status_code, headers, body)
+def _route_name(obj):
+    target = getattr(obj, '_fget', None) or type(obj)
+    return '%s.%s' % (target.__module__,
+                      getattr(target, '__qualname__', target.__name__))
 
-    def start(self, status_code=200, headers=None, body=None):
-        if headers is None:
-            headers = {'Content-type': 'text/plain'}
 
-        self.status_code = status_code
-        self.headers = headers
-        self._body = body
+class Instrumentation(object):
+    """Hooks fired through the life of each request.
+
+    Set an instance as ``_instrumentation`` on the Resource serving as WSGI
+    application. Every hook gets the request's Context and a monotonic
+    timestamp, which is also kept in ``context.timings`` under the hook's
+    name:
+
+    resolve_start
+        The request came in and routing starts.
+    resolve_end
+        The responding Resource, ``context.target``, was found.
+    handler_end
+        Its handler returned.
+    first_byte
+        The status and headers were handed to the server.
+    last_byte
+        The body was exhausted or closed. Bodies that are not generators are
+        handed to the server as a whole, so for those this coincides with
+        first_byte. Also fired, without first_byte, when routing or the
+        handler raised.
+
+    Hooks do nothing by default. Subclasses calling ``super()`` combine
+    through multiple inheritance. Without instrumentation each event costs
+    a single attribute check.
+    """
+
+    def resolve_start(self, context, timestamp):
+        pass
+
+    def resolve_end(self, context, timestamp):
+        pass
+
+    def handler_end(self, context, timestamp):
+        pass
+
+    def first_byte(self, context, timestamp):
+        pass
+
+    def last_byte(self, context, timestamp):
+        pass
+
+
+class _Histogram(object):
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max', 'phases')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.phases = {'resolve': 0.0, 'handler': 0.0, 'body': 0.0}
+
+    def add(self, duration):
+        self.counts[bisect_left(self.bounds, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
 
     @property
-    def headers_list(self):
-        return [(name, value)
-                for name, value in self.headers.iteritems()]
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the ``p``th percentile."""
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, bucket in zip(self.bounds, self.counts):
+            seen += bucket
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class RouteTimings(Instrumentation):
+    """Latency histograms per route.
+
+    Routes are named after the responding Resource and the request method.
+    Durations run from resolve_start to last_byte and fall in buckets with
+    the upper bounds in ``buckets``, in seconds. Each histogram also sums
+    the time spent resolving, in the handler and in the body.
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+               2.5, 5, 10)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def last_byte(self, context, timestamp):
+        super(RouteTimings, self).last_byte(context, timestamp)
+        timings = context.timings
+        start = timings['resolve_start']
+        resolved = timings.get('resolve_end', start)
+        handled = timings.get('handler_end', resolved)
+        route = '%s %s' % (context.request.method,
+                           _route_name(context.target))
+
+        with self._lock:
+            histogram = self._histograms.get(route)
+            if histogram is None:
+                histogram = self._histograms[route] = _Histogram(self.buckets)
+            histogram.add(timestamp - start)
+            histogram.phases['resolve'] += resolved - start
+            histogram.phases['handler'] += handled - resolved
+            histogram.phases['body'] += timestamp - handled
+
+    def routes(self):
+        """Return the histograms by route name."""
+        with self._lock:
+            return dict(self._histograms)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+class SlowestProfiles(Instrumentation):
+    """Keeps cProfile profiles of the ``keep`` slowest sampled requests.
+
+    A ``sample_rate`` fraction of requests is profiled from resolve_start
+    to last_byte, on the thread serving it. Requests on threads that are
+    already being profiled are skipped.
+    """
+
+    def __init__(self, keep=10, sample_rate=0.01):
+        self.keep = keep
+        self.sample_rate = sample_rate
+        self._slowest = []
+        self._sequence = count()
+        self._lock = threading.Lock()
+
+    def resolve_start(self, context, timestamp):
+        super(SlowestProfiles, self).resolve_start(context, timestamp)
+        if random() >= self.sample_rate:
+            return
+
+        from cProfile import Profile
+        profile = Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return
+        context._sp_profile = profile
+
+    def last_byte(self, context, timestamp):
+        super(SlowestProfiles, self).last_byte(context, timestamp)
+        profile = getattr(context, '_sp_profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        del context._sp_profile
+
+        duration = timestamp - context.timings['resolve_start']
+        entry = (duration, next(self._sequence), context.request.method,
+                 context.request.path, profile)
+        with self._lock:
+            if len(self._slowest) < self.keep:
+                heappush(self._slowest, entry)
+            else:
+                heappushpop(self._slowest, entry)
+
+    def profiles(self):
+        """Return (duration, method, path, pstats.Stats) tuples, slowest
+        first.
+        """
+        from pstats import Stats
+
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+        return [(duration, method, path, Stats(profile))
+                for duration, _, method, path, profile in slowest]
+
+
+class _Route(object):
+    """A regex route with converters for some of its parameters."""
+    __slots__ = ('regex', 'converters')
+
+    def __init__(self, regex, converters):
+        self.regex = regex
+        self.converters = converters
 
     @property
-    def status(self):
-        return {200: '200 OK',
-                404: '404 NOT FOUND',
-                500: '500 INTERNAL SERVER ERROR'}[self.status_code]
+    def pattern(self):
+        return self.regex.pattern
 
     @property
-    def body(self):
-        if hasattr(self._body, '__iter__'):
-            return self._body
-        else:
-            return [self._body]
+    def flags(self):
+        return self.regex.flags
 
-    @body.setter
-    def body(self, value):
-        self._body = value
+    @property
+    def groups(self):
+        return self.regex.groups
 
+    @property
+    def groupindex(self):
+        return self.regex.groupindex
 
-class Request(object):
-    pass
+    def search(self, path):
+        return self.regex.search(path)
 
+    def __eq__(self, other):
+        return (type(other) is _Route and self.regex == other.regex and
+                self.converters == other.converters)
 
-class Resource(threading.local):
-    def __init__(self, fget=None, fpost=None, fput=None, fdelete=None,
-                 obj=None, custom_routes=None):
-        if obj:
-            self.response = obj.response
-            self.response.start()
-            self.request = obj.request
-        else:
-            self.response = Response()
-            self.request = Request()
+    def __ne__(self, other):
+        return not self == other
 
-        self._fget = fget
-        self._fpost = fpost
-        self._fput = fput
-        self._fdelete = fdelete
-        if obj:
-            self._obj = obj
+    def __hash__(self):
+        return hash(self.regex)
 
-        if custom_routes:
-            self._sp_custom_routes = custom_routes
-        else:
-            self._sp_custom_routes = []
 
-    def __get__(self, obj, objtype):
-        if obj is None or self._fget is None:
-            return self
-        else:
-            return type(self)(self._fget, self._fpost, self._fput,
-                              self._fdelete, obj, self._sp_custom_routes)
+def _route_params(route, match):
+    params = match.groupdict()
+    converters = getattr(route, 'converters', None)
+    if converters:
+        for name, convert in converters.items():
+            if params.get(name) is not None:
+                params[name] = convert(params[name])
+    return params
 
-    def get(self, *args, **kwargs):
-        return self._fget(self._obj, *args, **kwargs)
 
-    def post(self, *args, **kwargs):
-        if len(args) == 1 and type(args[0]) is FunctionType:
-            return type(self)(self._fget, args[0], self._fput, self._fdelete)
-        else:
-            return self._fpost(self._obj, *args, **kwargs)
+class _RouteTable(object):
+    """The routes of a class: strings in a dict, and regexes combined into
+    alternations searched in one pass each. Alternations are split in
+    chunks of at most _MAX_GROUPS groups, the most Python 2 supports in one
+    regex. Regexes that can't be combined are searched one by one, last.
+    """
+    _DEFAULT_FLAGS = re_compile('').flags
+    _UNCOMBINABLE = re_compile(r'\\\d|\(\?P=|\(\?\(|\(\?[aiLmsux]')
+    _GROUP_NAME = re_compile(r'(?<!\\)\(\?P<\w+>')
+    _MAX_GROUPS = 99
 
-    def put(self, *args, **kwargs):
-        if len(args) == 1 and type(args[0]) is FunctionType:
-            return type(self)(self._fget, self._fpost, args[0], self._fdelete)
-        else:
-            return self._fput(self._obj, *args, **kwargs)
+    def __init__(self, cls, generation):
+        self.generation = generation
+        self.strings = {}
+        self.patterns = {}
+        self.chunks = []
+        self.sequential = []
+        self.searches = {}
+        self._ordered = []
+        alternatives = []
+        groups = 0
 
-    def delete(self, *args, **kwargs):
-        if len(args) == 1 and type(args[0]) is FunctionType:
-            return type(self)(self._fget, self._fpost, self._fput, args[0])
-        else:
-            return self._fdelete(self._obj, *args, **kwargs)
+        for name in cls.__dict__:
+            try:
+                routes = getattr(getattr(cls, name), '_sp_custom_routes')
+            except AttributeError:
+                continue
 
-    def __call__(self, *args):
-        def application(environ, start_response):
-            response = get_response(self, environ['REQUEST_METHOD'],
-                                    environ['PATH_INFO'])
+            for route in routes:
+                if not hasattr(route, 'search'):
+                    self.strings.setdefault(route, name)
+                elif (route.flags != self._DEFAULT_FLAGS or
+                      self._UNCOMBINABLE.search(route.pattern) or
+                      route.groups >= self._MAX_GROUPS):
+                    self.sequential.append((name, route))
+                else:
+                    if groups + route.groups + 1 > self._MAX_GROUPS:
+                        self._combine(alternatives)
+                        alternatives, groups = [], 0
+                    group = '_sp%d' % len(self._ordered)
+                    self.patterns[group] = name, route
+                    self._ordered.append((name, route))
+                    self.searches[id(route)] = len(self.chunks) + 1
+                    alternatives.append('(?P<%s>%s)' % (
+                        group, self._GROUP_NAME.sub('(', route.pattern)))
+                    groups += route.groups + 1
+        self._combine(alternatives)
 
-            try:
-                first_part = response.body.next()
-            except (StopIteration, AttributeError):
-                start_response(response.status,
-                               response.headers_list)
-            else:
-                start_response(response.status,
-                               response.headers_list)
-                yield first_part
+        for i, (name, route) in enumerate(self.sequential):
+            self.searches[id(route)] = len(self.chunks) + i + 1
+        self._ordered.extend(self.sequential)
 
-            for part in response.body:
-                yield part
+    def _combine(self, alternatives):
+        if alternatives:
+            self.chunks.append(re_compile('|'.join(alternatives)))
 
-        if len(args) == 1 and type(args[0]) is FunctionType:
-            return type(self)(args[0])
-        else:
-            return application(*args[:2])
+    def match(self, path):
+        name = self.strings.get(path)
+        if name is not None:
+            return name, {}
 
+        for chunk in self.chunks:
+            match = chunk.search(path)
+            if match:
+                name, route = self.patterns[match.lastgroup]
+                return name, _route_params(route, route.search(path))
 
-class NotFound(Resource):
-    def get(self):
-        self.response.status_code = 404
-        return 'Not found'
+        for name, route in self.sequential:
+            match = route.search(path)
+            if match:
+                return name, _route_params(route, match)
 
-    post = get
-    put = get
-    delete = get
+        return None, {}
+
+    def regexes(self):
+        """Return (name, regex) pairs in the order they are tried."""
+        return list(self._ordered)
 
 
 class Dispatcher(object):
+    """Looks up the members of Resources by path, including custom routes.
+
+    Routes may capture parameters with ``<converter:name>`` placeholders,
+    or just ``<name>`` for a single path segment, in both plain and regex
+    routes:
+
+        @dispatcher.route('contact/<int:id_>')
+        @Resource
+        def contact(self, id_):
+            ...
+
+    Placeholders are compiled into the route's regex when it is added, and
+    their values converted before they reach the handler. ``converters``
+    maps converter names to a regex and a conversion function, or None to
+    keep the string; the function must accept anything the regex matches.
+    """
+    _generation = 0
+    _tables = WeakKeyDictionary()
+    _PLACEHOLDER = re_compile(r'(?<!\?P)<(?:(\w+):)?(\w+)>')
+
+    converters = {
+        'str': (r'[^/]+', None),
+        'int': (r'\d+', int),
+        'slug': (r'[-\w]+', None),
+        'uuid': (r'[0-9a-fA-F]{8}-(?:[0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}',
+                 UUID),
+        'path': (r'.+', None),
+    }
+
+    @classmethod
+    def invalidate(cls):
+        cls._generation += 1
+
+    def _compile(self, pattern, escape):
+        parts = []
+        converters = {}
+        position = 0
+        for match in self._PLACEHOLDER.finditer(pattern):
+            literal = pattern[position:match.start()]
+            parts.append(re_escape(literal) if escape else literal)
+
+            kind, name = match.group(1) or 'str', match.group(2)
+            try:
+                regex, convert = self.converters[kind]
+            except KeyError:
+                raise ValueError('Unknown route converter: %r' % kind)
+            parts.append('(?P<%s>%s)' % (name, regex))
+            if convert is not None:
+                converters[name] = convert
+            position = match.end()
+
+        literal = pattern[position:]
+        parts.append(re_escape(literal) if escape else literal)
+        regex = ''.join(parts)
+        if escape:
+            regex = '^%s$' % regex
+        regex = re_compile(regex)
+        return _Route(regex, converters) if converters else regex
+
     def route(self, route=None, re=None):
         if re and not re.endswith('$'):
             re += '$'
         if re and not re.startswith('^'):
             re = '^' + re
 
+        if (route and not hasattr(route, 'search') and
+                self._PLACEHOLDER.search(route)):
+            route = self._compile(route, escape=True)
+        if re:
+            re = (self._compile(re, escape=False)
+                  if self._PLACEHOLDER.search(re) else re_compile(re))
+
         def decorator(obj):
             def set_route(obj_):
                 if not hasattr(obj, '_sp_custom_routes'):
@@ -186,13 +2186,20 @@ class Dispatcher(object):
                 if route:
                     obj_._sp_custom_routes.append(route)
                 if re:
-                    obj_._sp_custom_routes.append(re_compile(re))
+                    obj_._sp_custom_routes.append(re)
 
             set_route(getattr(obj, '__func__', obj))
+            self.invalidate()
             return obj
 
         return decorator
 
+    def table(self, cls):
+        table = self._tables.get(cls)
+        if table is None or table.generation != self._generation:
+            table = self._tables[cls] = _RouteTable(cls, self._generation)
+        return table
+
     def get(self, obj, path, default=None):
         if not path.startswith('_'):
             try:
@@ -200,44 +2207,356 @@ class Dispatcher(object):
             except AttributeError:
                 pass
 
-        custom_routes = {}
-        for attr in obj.__class__.__dict__:
-            attr = getattr(obj, attr)
-            if hasattr(attr, '_sp_custom_routes'):
-                custom_routes[attr] = attr._sp_custom_routes
-        for attr in obj.__dict__:
-            attr = getattr(obj, attr)
-            if hasattr(attr, '_sp_custom_routes'):
-                custom_routes[attr] = attr._sp_custom_routes
-
-        for custom_obj, paths in custom_routes.iteritems():
+        name, ctx = self.table(type(obj)).match(path)
+        if name is not None:
+            return getattr(obj, name), ctx
+
+        for attr in getattr(obj, '__dict__', {}).values():
+            paths = getattr(attr, '_sp_custom_routes', None)
+            if not paths:
+                continue
+
             if path in paths:
-                return custom_obj, {}
+                return attr, {}
 
             for p in paths:
                 try:
                     match = p.search(path)
                     if match:
-                        return custom_obj, match.groupdict()
+                        return attr, _route_params(p, match)
                 except AttributeError:
                     continue
+
+        return default, {}
+
+
+_default_dispatcher = Dispatcher()
+
+
+def _plain_routes(obj):
+    """Yield (route, name, member) for the attributes and custom string
+    routes of ``obj``, attributes first.
+    """
+    for name in dir(obj):
+        if not name.startswith('_'):
+            member = getattr(obj, name, None)
+            if isinstance(member, (Resource, _BoundResource)):
+                yield name, name, member
+
+    dispatcher = getattr(obj, '_dispatcher', _default_dispatcher)
+    for route, name in dispatcher.table(type(obj)).strings.items():
+        yield route, name, getattr(obj, name)
+
+    for name, member in getattr(obj, '__dict__', {}).items():
+        for route in getattr(member, '_sp_custom_routes', None) or []:
+            if not hasattr(route, 'search'):
+                yield route, name, member
+
+
+def _regex_routes(obj):
+    """Yield (route, name, member) for the regex routes of ``obj``, in the
+    order they are tried.
+    """
+    dispatcher = getattr(obj, '_dispatcher', _default_dispatcher)
+    for name, route in dispatcher.table(type(obj)).regexes():
+        yield route, name, getattr(obj, name)
+
+    for name, member in getattr(obj, '__dict__', {}).items():
+        for route in getattr(member, '_sp_custom_routes', None) or []:
+            if hasattr(route, 'search'):
+                yield route, name, member
+
+
+class _TrieNode(object):
+    def __init__(self):
+        self.children = {}
+        self.chain = None
+        self.target = None
+        self.patterns = []
+
+
+class Resolver(object):
+    """Resolve full paths against a Resource tree flattened into a trie.
+
+    The tree below ``root`` is walked once, when the resolver is created.
+    Plain and compound (``'full/path'``) attribute names and custom string
+    routes become trie edges, while regex routes are kept per Resource and
+    tried against the remaining path, like ``get_response`` does. Paths
+    the trie cannot resolve fall back to ``get_response``.
+    """
+
+    def __init__(self, root):
+        self._root = _TrieNode()
+        self._build(self._root, root, (), 0, set())
+
+    def _build(self, node, obj, chain, depth, seen):
+        node.chain = chain
+        if node.target is None or node.target[0] > depth:
+            node.target = depth, chain
+
+        key = id(getattr(obj, '_resource', obj))
+        if key in seen:
+            return
+        seen = seen | set([key])
+
+        for route, name, member in _plain_routes(obj):
+            if not isinstance(member, (Resource, _BoundResource)):
+                continue
+
+            parts = route.strip('/').split('/')
+            child = node
+            for part in parts:
+                child = child.children.setdefault(part, _TrieNode())
+
+            if len(parts) > 1:
+                if child.target is None or child.target[0] > depth:
+                    child.target = depth, chain + (name,)
+            elif child.chain is None:
+                self._build(child, member, chain + (name,), depth + 1, seen)
+
+        for route, name, member in _regex_routes(obj):
+            if isinstance(member, (Resource, _BoundResource)):
+                subnode = _TrieNode()
+                self._build(subnode, member, chain + (name,), 0, seen)
+                node.patterns.append((route, subnode))
+
+    def _match(self, node, segments, start):
+        owners = []
+        target = None
+        i = start
+        while True:
+            if node.chain is not None:
+                owners.append((i, node))
+            if i == len(segments):
+                target = node.target
+                break
+            node = node.children.get(segments[i])
+            if node is None:
+                break
+            i += 1
+
+        for i, owner in owners:
+            if target is not None and target[0] <= i - start:
+                break
+
+            remainder = '/'.join(segments[i:])
+            for route, subnode in owner.patterns:
+                match = route.search(remainder)
+                if match:
+                    return subnode.chain, _route_params(route, match)
+
+        if target is not None:
+            return target[1], {}
+
+        if owners:
+            i, owner = owners[-1]
+            if i < len(segments):
+                for route, subnode in owner.patterns:
+                    match = route.search(segments[i])
+                    if match:
+                        result = self._match(subnode, segments, i + 1)
+                        if result is not None:
+                            chain, params = result
+                            params = dict(_route_params(route, match),
+                                          **params)
+                            return chain, params
+                        return None
+
+        return None
+
+    def resolve(self, obj, path):
+        """Return the Resource at ``path`` below ``obj`` and the parameters
+        captured by regex routes on the way, or None if it can't be found.
+        """
+        path = (path or '').strip('/')
+        segments = path.split('/') if path else []
+
+        result = self._match(self._root, segments, 0)
+        if result is None:
+            return None
+
+        chain, params = result
+        try:
+            for name in chain:
+                obj = getattr(obj, name)
+        except AttributeError:
+            return None
+        return obj, params
+
+    def __call__(self, obj, method, path=None, context=None):
+        if context is None:
+            context = Context()
+
+        result = self.resolve(obj, path)
+        if result is None:
+            return get_response(obj, method, path, context=context)
+
+        target, params = result
+        with context:
+            return get_response.respond(target, method, path, params)
+
+
+class _CacheEntry(object):
+    __slots__ = ('data', 'mtime', 'checked')
+
+    def __init__(self, data, mtime, checked):
+        self.data = data
+        self.mtime = mtime
+        self.checked = checked
+
+
+class StaticCache(object):
+    """In-memory LRU cache of small files, to be shared by Static instances.
+
+    At most ``max_bytes`` of file contents are kept, and files larger than
+    ``max_file_size`` are never cached. An entry is checked against the
+    file's mtime and size when it is older than ``stat_interval`` seconds.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, max_file_size=256 * 1024,
+                 stat_interval=1.0):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.stat_interval = stat_interval
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def accepts(self, size):
+        return size <= min(self.max_file_size, self.max_bytes)
+
+    def get(self, path):
+        now = time()
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self._entries[path] = entry
+
+        if entry is not None and now - entry.checked >= self.stat_interval:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+
+            if (stat is None or stat.st_mtime != entry.mtime or
+                    stat.st_size != len(entry.data)):
+                self._discard(path, entry)
+                entry = None
+            else:
+                entry.checked = now
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def put(self, path, data, mtime):
+        entry = _CacheEntry(data, mtime, time())
+        with self._lock:
+            previous = self._entries.pop(path, None)
+            if previous is not None:
+                self.size -= len(previous.data)
+
+            self._entries[path] = entry
+            self.size += len(data)
+
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.data)
+                self.evictions += 1
+        return entry
+
+    def _discard(self, path, entry):
+        with self._lock:
+            if self._entries.get(path) is entry:
+                del self._entries[path]
+                self.size -= len(entry.data)
+
+
+class _DirEntry(object):
+    """The parts of os.DirEntry that Static uses, for Pythons without
+    scandir.
+    """
+    __slots__ = ('name', 'path', '_stat')
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+class _Listing(object):
+    KEYS = {'name': lambda entry: entry.name,
+            'size': lambda entry: entry.stat().st_size,
+            'mtime': lambda entry: entry.stat().st_mtime}
+
+    def __init__(self, path, mtime):
+        self.mtime = mtime
+        if scandir is not None:
+            self._entries = list(scandir(path))
         else:
-            return default, {}
+            self._entries = [_DirEntry(path, name)
+                             for name in os.listdir(path)]
+        self._sorted = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def iter(self, key='name', reverse=False, start=0, stop=None):
+        entries = self._sorted.get(key)
+        if entries is None:
+            entries = self._sorted[key] = sorted(self._entries,
+                                                 key=self.KEYS[key])
+
+        return islice(reversed(entries) if reverse else iter(entries),
+                      start, stop)
 
 
 class Static(Resource):
     _dispatcher = Dispatcher()
 
-    _DIRTEMPLATE_HEADER = '<h1>Directory listing</h1><ul>'
-    _DIRTEMPLATE_ITEM = '<li><a href="%(url)s">%(title)s</a></li>'
-    _DIRTEMPLATE_FOOTER = '</ul>'
+    _DIRTEMPLATE = Template(
+        '<h1>Directory listing</h1><ul>'
+        '{% for entry in entries %}'
+        '<li><a href="{{ join(path, entry.name) }}">{{ entry.name }}</a></li>'
+        '{% endfor %}</ul>', 'Static._DIRTEMPLATE')
+
+    _DIR_BATCH_SIZE = 256
+    _DIR_PAGE_SIZE = None
+    _DIR_LISTINGS = 64
+    _MISSING_INTERVAL = 1.0
+    _MISSING_ENTRIES = 1024
 
-    def __init__(self, path, rel=''):
+    _BLOCK_SIZE = 64 * 1024
+
+    _PRECOMPRESSED = (('.br', 'br'), ('.gz', 'gzip'))
+
+    def __init__(self, path, rel='', cache=None, precompressed=True):
         super(Static, self).__init__()
 
         self._path = os.path.join(os.path.dirname(rel), path)
         self._mime_type, _ = guess_type(path)
         self._sp_custom_routes = [os.path.basename(path)]
+        self._cache = cache
+        self._precompressed = precompressed
+        self._listings = OrderedDict()
+        self._missing = OrderedDict()
+        self._lock = threading.Lock()
 
     def get(self):
         return self._get(self._path)
@@ -251,31 +2570,269 @@ class Static(Resource):
                                           .split('/', 1)[1]))
 
     def _get(self, path):
-        if os.path.isdir(path):
+        if self._precompressed:
+            for suffix, encoding in self._PRECOMPRESSED:
+                if (_accepts_encoding(self.request.environ, encoding) and
+                        not self._known_missing(path + suffix)):
+                    encoded = self._cached(path + suffix)
+                    if encoded is not None or os.path.isfile(path + suffix):
+                        return self._file(path + suffix, encoded, path,
+                                          encoding)
+                    self._remember_missing(path + suffix)
+
+        cached = self._cached(path)
+        if cached is None and os.path.isdir(path):
             return self._iter_dir(path)
         else:
-            return self._iter_file(path)
+            return self._file(path, cached)
+
+    def _known_missing(self, path):
+        """Whether path was found missing in the last _MISSING_INTERVAL
+        seconds. Saves looking for precompressed siblings on every request.
+        """
+        expires = self._missing.get(path)
+        return expires is not None and expires > monotonic()
+
+    def _remember_missing(self, path):
+        with self._lock:
+            self._missing.pop(path, None)
+            self._missing[path] = monotonic() + self._MISSING_INTERVAL
+            while len(self._missing) > self._MISSING_ENTRIES:
+                self._missing.popitem(last=False)
+
+    def _cached(self, path):
+        if self._cache is not None:
+            return self._cache.get(path)
+
+    def _listing(self, path):
+        """Return the listing of the directory at path, keeping those of
+        the _DIR_LISTINGS most recently listed directories.
+        """
+        mtime = os.stat(path).st_mtime
+        with self._lock:
+            listing = self._listings.pop(path, None)
+            if listing is not None and listing.mtime == mtime:
+                self._listings[path] = listing
+                return listing
+
+        listing = _Listing(path, mtime)
+        with self._lock:
+            self._listings[path] = listing
+            while len(self._listings) > self._DIR_LISTINGS:
+                self._listings.popitem(last=False)
+        return listing
 
     def _iter_dir(self, path):
+        """List a directory, sorted and optionally paginated through the
+        ``sort`` (name, size or mtime), ``order``, ``page`` and ``per_page``
+        query parameters. Entries are read once per directory mtime.
+        """
         self.response.headers['Content-type'] = 'text/html'
 
-        yield self._DIRTEMPLATE_HEADER
-        for p in os.listdir(path):
-            yield self._DIRTEMPLATE_ITEM % {
-                'url': os.path.join(self.request.path, p),
-                'title': p}
-        yield self._DIRTEMPLATE_FOOTER
+        query = parse_qs(self.request.environ.get('QUERY_STRING', ''))
+        key = query.get('sort', ['name'])[0]
+        if key not in _Listing.KEYS:
+            key = 'name'
+        reverse = query.get('order', ['asc'])[0] == 'desc'
 
-    def _iter_file(self, path):
         try:
-            f = open(path, 'r')
-        except IOError as e:
-            if e.errno == errno.ENOENT:
-                self.response.status_code = 404
-                yield 'Not found'
-            else:
-                raise
+            per_page = int(query.get('per_page', [self._DIR_PAGE_SIZE])[0])
+            page = max(int(query.get('page', [1])[0]), 1)
+        except (TypeError, ValueError):
+            per_page = None
+        if per_page is None or per_page < 1:
+            start, stop = 0, None
+        else:
+            start, stop = (page - 1) * per_page, page * per_page
+
+        entries = self._listing(path).iter(key, reverse, start, stop)
+        for chunk in self._DIRTEMPLATE.stream({'entries': entries,
+                                               'join': os.path.join,
+                                               'path': self.request.path},
+                                              self._DIR_BATCH_SIZE):
+            yield chunk
+
+    def _file(self, path, cached=None, original=None, encoding=None):
+        if cached is not None:
+            source, mtime, size = cached.data, cached.mtime, len(cached.data)
+        else:
+            try:
+                source = open(path, 'rb')
+            except IOError as e:
+                if e.errno == errno.ENOENT:
+                    self.response.status_code = 404
+                    return ['Not found']
+                else:
+                    raise
+
+            stat = os.fstat(source.fileno())
+            mtime, size = stat.st_mtime, stat.st_size
+            if self._cache is not None and self._cache.accepts(size):
+                with source:
+                    source = self._cache.put(path, source.read(), mtime).data
+
+        etag = '"%x-%x"' % (int(mtime), size)
+        if original is None and path == self._path:
+            mime_type = self._mime_type
         else:
-            self.response.headers['Content-type'] = self._mime_type
-            with  f:
-                yield f.read()
+            mime_type, _ = guess_type(original or path)
+
+        headers = self.response.headers
+        headers['Content-type'] = mime_type
+        if encoding is not None:
+            etag = '"%x-%x-%s"' % (int(mtime), size, encoding)
+            headers['Content-Encoding'] = encoding
+            headers['Vary'] = 'Accept-Encoding'
+        headers['ETag'] = etag
+        headers['Last-Modified'] = formatdate(mtime, usegmt=True)
+        headers['Accept-Ranges'] = 'bytes'
+
+        if self._not_modified(etag, mtime):
+            self._close(source)
+            # A 304 keeps only the validators and caching headers.
+            for name in 'Content-type', 'Content-Encoding', 'Accept-Ranges':
+                headers.pop(name, None)
+            self.response.status_code = 304
+            return []
+
+        ranges = self._ranges(etag, mtime, size)
+        if ranges is None:
+            headers['Content-Length'] = str(size)
+            if not hasattr(source, 'read'):
+                return [source]
+            file_wrapper = self.request.environ.get('wsgi.file_wrapper')
+            if file_wrapper is not None:
+                return file_wrapper(source, self._BLOCK_SIZE)
+            return self._iter_file(source)
+
+        if not ranges:
+            self._close(source)
+            self.response.status_code = 416
+            headers['Content-Range'] = 'bytes */%d' % size
+            headers['Content-Length'] = '0'
+            return []
+
+        self.response.status_code = 206
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            headers['Content-Length'] = str(end - start + 1)
+            if not hasattr(source, 'read'):
+                return [source[start:end + 1]]
+            return self._iter_file(source, start, end - start + 1)
+
+        boundary = uuid4().hex
+        parts = [('--%s\r\nContent-type: %s\r\n'
+                  'Content-Range: bytes %d-%d/%d\r\n\r\n' % (
+                      boundary, mime_type or 'application/octet-stream',
+                      start, end, size),
+                  start, end - start + 1)
+                 for start, end in ranges]
+        trailer = '--%s--\r\n' % boundary
+
+        headers['Content-type'] = 'multipart/byteranges; boundary=%s' % boundary
+        headers['Content-Length'] = str(
+            sum(len(head) + length + 2 for head, _, length in parts) +
+            len(trailer))
+        return self._iter_parts(source, parts, trailer)
+
+    def _close(self, source):
+        if hasattr(source, 'close'):
+            source.close()
+
+    def _not_modified(self, etag, mtime):
+        environ = self.request.environ
+
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since is not None:
+            since = parsedate_tz(if_modified_since)
+            return since is not None and int(mtime) <= mktime_tz(since)
+
+        return False
+
+    def _ranges(self, etag, mtime, size):
+        """Return the satisfiable (start, end) byte ranges requested, or
+        None if the whole file should be sent.
+        """
+        environ = self.request.environ
+
+        header = environ.get('HTTP_RANGE')
+        if header is None:
+            return None
+
+        if_range = environ.get('HTTP_IF_RANGE')
+        if if_range is not None:
+            if if_range.startswith(('"', 'W/')):
+                if if_range != etag:
+                    return None
+            else:
+                date = parsedate_tz(if_range)
+                if date is None or mktime_tz(date) != int(mtime):
+                    return None
+
+        units, _, spec = header.partition('=')
+        if units.strip() != 'bytes':
+            return None
+
+        ranges = []
+        for part in spec.split(','):
+            start, dash, end = part.strip().partition('-')
+            try:
+                if not dash:
+                    return None
+                elif start:
+                    start = int(start)
+                    if end:
+                        end = int(end)
+                        if start > end:
+                            return None
+                    else:
+                        end = size - 1
+                else:
+                    start, end = max(size - int(end), 0), size - 1
+            except ValueError:
+                return None
+
+            if start < size and end >= start:
+                ranges.append((start, min(end, size - 1)))
+
+        return ranges
+
+    def _iter_file(self, f, start=0, length=None):
+        with f:
+            for block in self._iter_range(f, start, length):
+                yield block
+
+    def _iter_parts(self, source, parts, trailer):
+        try:
+            for head, start, length in parts:
+                yield head
+                if hasattr(source, 'read'):
+                    for block in self._iter_range(source, start, length):
+                        yield block
+                else:
+                    yield source[start:start + length]
+                yield '\r\n'
+            yield trailer
+        finally:
+            self._close(source)
+
+    def _iter_range(self, f, start, length):
+        if start:
+            f.seek(start)
+
+        while length is None or length > 0:
+            size = self._BLOCK_SIZE
+            if length is not None:
+                size = min(size, length)
+                length -= size
+
+            block = f.read(size)
+            if not block:
+                break
+            yield block
@@ -0,0 +1,259 @@
+"""ASGI support for Resource trees. Requires Python 3.6 or later.
+
+    from sinpy.asgi import ASGIApplication
+
+    application = ASGIApplication(Site())
+
+Routing is shared with the WSGI application. Handlers may be plain
+functions, ``async def`` coroutines or async generators. Plain handlers and
+the chunks of plain generator bodies run in a bounded thread pool so that
+they never block the event loop. Stream bodies are read on the event loop
+and hold no thread while they wait.
+
+Handlers see a Request built from a WSGI style environ: the query string,
+headers and server variables of the scope, and the request body, read
+from ``receive`` before routing, as ``wsgi.input``.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import inspect
+from tempfile import SpooledTemporaryFile
+
+from sinpy import (_EMPTY, Context, FLUSH, get_response, Request,
+                   RequestTooLarge, StreamClosed)
+
+_DONE = object()
+
+
+def feed_stream(stream, source):
+    """Put the chunks of async iterable ``source`` in ``stream``, on a new
+    event loop. Stream runs this in a thread of its own for async
+    generators, so blocking in ``put`` is what throttles the source.
+    """
+    async def feed():
+        try:
+            async for chunk in source:
+                stream.put(chunk)
+        except StreamClosed:
+            pass
+        finally:
+            stream.finish()
+            if hasattr(source, 'aclose'):
+                await source.aclose()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(feed())
+    finally:
+        loop.close()
+
+
+async def iter_stream(stream):
+    """Yield the chunks of a Stream on the running event loop.
+
+    Async sources are iterated right here, inside the stream's Context.
+    Waiting for producers is done on an asyncio.Event they set through
+    the loop, so an idle stream holds no thread. Only generator sources,
+    which may block, are pulled in the loop's default executor.
+    """
+    source = stream.source
+    if hasattr(source, '__aiter__'):
+        try:
+            async for chunk in source:
+                if stream.closed:
+                    break
+                if chunk is not FLUSH:
+                    yield chunk
+            else:
+                stream.finish()
+        finally:
+            if hasattr(source, 'aclose'):
+                await source.aclose()
+        return
+
+    loop = asyncio.get_running_loop()
+    if source is not None:
+        while True:
+            chunk = await loop.run_in_executor(None, next, stream, _DONE)
+            if chunk is _DONE:
+                return
+            yield chunk
+
+    ready = asyncio.Event()
+
+    def wake():
+        loop.call_soon_threadsafe(ready.set)
+
+    stream._listeners.append(wake)
+    try:
+        while True:
+            ready.clear()
+            try:
+                chunk = stream._get(block=False)
+            except StopIteration:
+                return
+            if chunk is _EMPTY:
+                await ready.wait()
+            elif chunk is not FLUSH:
+                yield chunk
+    finally:
+        stream._listeners.remove(wake)
+
+
+class ASGIApplication(object):
+    def __init__(self, resource, max_workers=None, encoding='utf-8'):
+        self.resource = resource
+        self.encoding = encoding
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported scope type: %r' % scope['type'])
+
+        environ = await self._environ(scope, receive)
+        if environ is None:
+            return
+
+        loop = asyncio.get_running_loop()
+        context = Context(Request(environ))
+        response = await loop.run_in_executor(
+            self._executor,
+            partial(get_response, self.resource, scope['method'],
+                    scope['path'], context=context))
+
+        with context:
+            started = False
+            chunks = self._iter_body(loop, context, response._body)
+            try:
+                try:
+                    async for chunk in chunks:
+                        if chunk is FLUSH:
+                            continue
+                        if not started:
+                            await self._start(send, context.response)
+                            started = True
+                        if scope['method'] == 'HEAD':
+                            break
+                        await send({'type': 'http.response.body',
+                                    'body': chunk,
+                                    'more_body': True})
+                except RequestTooLarge:
+                    # Generators only read request.body once iterated.
+                    if started:
+                        raise
+                    context.response.start(413)
+                    await self._start(send, context.response)
+                    started = True
+                    if scope['method'] != 'HEAD':
+                        await send({'type': 'http.response.body',
+                                    'body': b'Request entity too large',
+                                    'more_body': True})
+            finally:
+                await chunks.aclose()
+                # Lets bodies like Stream know when the client went away.
+                if hasattr(response._body, 'close'):
+                    response._body.close()
+
+            if not started:
+                await self._start(send, context.response)
+            await send({'type': 'http.response.body', 'body': b''})
+
+    async def _environ(self, scope, receive):
+        """Return a WSGI environ for scope, with the request body read
+        from receive as wsgi.input, or None if the client went away.
+        """
+        environ = {'REQUEST_METHOD': scope['method'],
+                   'SCRIPT_NAME': scope.get('root_path', ''),
+                   'PATH_INFO': scope['path'],
+                   'QUERY_STRING': scope.get('query_string',
+                                             b'').decode('latin-1'),
+                   'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version',
+                                                            '1.1'),
+                   'wsgi.url_scheme': scope.get('scheme', 'http'),
+                   'wsgi.input_terminated': True}
+        if scope.get('server'):
+            environ['SERVER_NAME'] = scope['server'][0]
+            environ['SERVER_PORT'] = str(scope['server'][1])
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+
+        for name, value in scope.get('headers', ()):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            value = value.decode('latin-1')
+            if name in environ:
+                separator = '; ' if name == 'HTTP_COOKIE' else ','
+                value = environ[name] + separator + value
+            environ[name] = value
+
+        # Bodies beyond Request._MAX_BODY_SIZE are cut one byte past the
+        # limit, which is enough for Request to answer them with a 413.
+        body = SpooledTemporaryFile(max_size=Request._SPOOL_SIZE)
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            chunk = message.get('body', b'')
+            if size <= Request._MAX_BODY_SIZE:
+                chunk = chunk[:Request._MAX_BODY_SIZE + 1 - size]
+                body.write(chunk)
+                size += len(chunk)
+            if not message.get('more_body', False):
+                break
+        body.seek(0)
+        environ['wsgi.input'] = body
+        return environ
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _start(self, send, response):
+        await send({'type': 'http.response.start',
+                    'status': response.status_code,
+                    'headers': [(name.lower().encode('latin-1'),
+                                 str(value).encode('latin-1'))
+                                for name, value in response.headers.items()]})
+
+    async def _iter_body(self, loop, context, body):
+        if inspect.isawaitable(body):
+            body = await body
+
+        if hasattr(body, '__aiter__'):
+            async for chunk in body:
+                yield self._encode(chunk)
+        elif body is None or isinstance(body, (str, bytes)):
+            if body:
+                yield self._encode(body)
+        elif isinstance(body, (list, tuple)):
+            for chunk in body:
+                yield self._encode(chunk)
+        else:
+            iterator = iter(body)
+            while True:
+                chunk = await loop.run_in_executor(
+                    self._executor, self._next, context, iterator)
+                if chunk is _DONE:
+                    break
+                yield self._encode(chunk)
+
+    def _next(self, context, iterator):
+        with context:
+            return next(iterator, _DONE)
+
+    def _encode(self, chunk):
+        if chunk is FLUSH or isinstance(chunk, bytes):
+            return chunk
+        return str(chunk).encode(self.encoding)
@@ -0,0 +1,227 @@
+"""Route manifests: every route of a Resource tree, checked up front.
+
+    from sinpy.manifest import Manifest
+
+    manifest = Manifest(Site())
+
+Building a manifest walks the tree once and compiles the route and method
+tables of every Resource on the way, so the first requests don't have to.
+Routes that conflict or can never be reached raise RouteConflict. Each
+route records its path, the methods it answers and how many regex
+searches reaching it may take. Regex segments are shown in braces.
+Handlers that require route parameters their path does not capture are
+left out of its methods and listed in ``unreachable``, unless the path is
+the bare attribute name of a member that has routes of its own.
+
+Manifests can be saved as JSON and loaded again, for instance to check at
+deploy time that the routes have not changed. To list the routes of an
+application, run:
+
+    python -m sinpy.manifest package.module:application [--timing]
+"""
+from __future__ import print_function
+
+import argparse
+from collections import namedtuple
+from importlib import import_module
+import json
+from timeit import default_timer
+
+from sinpy import (_allowed_methods, _BoundResource, _default_dispatcher,
+                   _handler_kwargs, _method_handler, _method_table,
+                   _plain_routes, _regex_routes, _route_name, Resolver,
+                   Resource)
+
+Route = namedtuple('Route', 'path kind target methods searches')
+
+
+class RouteConflict(ValueError):
+    pass
+
+
+class Manifest(object):
+    def __init__(self, root, strict=True):
+        self.root = root
+        self.routes = []
+        self.problems = []
+        self.unreachable = []
+        self._walk(root, '', 'root', 0, frozenset(), frozenset())
+
+        if strict and self.problems:
+            raise RouteConflict('\n'.join(self.problems))
+
+    def _walk(self, obj, path, kind, searches, seen, params):
+        _method_table(type(obj))
+        # Members with routes of their own answer 404 at their bare
+        # attribute name when those routes capture their parameters.
+        report = kind != 'attribute' or not getattr(obj, '_sp_custom_routes',
+                                                    None)
+        self.routes.append(Route(path or '/', kind, _route_name(obj),
+                                 self._methods(obj, path or '/', params,
+                                               report),
+                                 searches))
+
+        key = id(getattr(obj, '_resource', obj))
+        if key in seen:
+            return
+        seen = seen | frozenset([key])
+        self._check(obj, path or '/')
+
+        for route, name, member in _plain_routes(obj):
+            if isinstance(member, (Resource, _BoundResource)):
+                self._walk(member, '%s/%s' % (path, route),
+                           'attribute' if route == name else 'string',
+                           searches, seen, params)
+
+        dispatcher = getattr(obj, '_dispatcher', _default_dispatcher)
+        table = dispatcher.table(type(obj))
+        tried = len(table.chunks) + len(table.sequential)
+
+        for route, name, member in _regex_routes(obj):
+            cost = table.searches.get(id(route))
+            if cost is None:
+                tried += 1
+                cost = tried
+            if isinstance(member, (Resource, _BoundResource)):
+                pattern = route.pattern.lstrip('^').rstrip('$')
+                self._walk(member, '%s/{%s}' % (path, pattern), 'regex',
+                           searches + cost, seen,
+                           params | frozenset(route.groupindex))
+
+    def _methods(self, obj, path, params, report=True):
+        """Return the methods obj answers at path, leaving out those whose
+        handlers require parameters not among params. Those are listed in
+        unreachable if report is true.
+        """
+        params = dict.fromkeys(params)
+        methods = []
+        for method in _allowed_methods(obj):
+            handler, args = _method_handler(obj, method)
+            if (handler is not None and
+                    _handler_kwargs(handler, len(args), params) is None):
+                if not report:
+                    continue
+                self.unreachable.append(
+                    '%s: the %s handler of %s requires route parameters '
+                    'this path does not capture' % (path, method,
+                                                    _route_name(obj)))
+            else:
+                methods.append(method)
+        return tuple(methods)
+
+    def _check(self, obj, path):
+        attributes = set(route for route, name, _ in _plain_routes(obj)
+                         if route == name)
+        claimed = {}
+        patterns = {}
+        members = dict(type(obj).__dict__)
+        members.update(getattr(obj, '__dict__', {}))
+
+        for name in sorted(members):
+            for route in getattr(members[name], '_sp_custom_routes',
+                                 None) or []:
+                if hasattr(route, 'search'):
+                    claims, key = patterns, route.pattern
+                else:
+                    claims, key = claimed, route
+                    if route in attributes and route != name:
+                        self.problems.append(
+                            '%s: route %r of %r is shadowed by the '
+                            'attribute of that name' % (path, route, name))
+                if key in claims and claims[key] != name:
+                    self.problems.append(
+                        '%s: route %r is claimed by both %r and %r'
+                        % (path, key, claims[key], name))
+                claims.setdefault(key, name)
+
+    def __iter__(self):
+        return iter(self.routes)
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __eq__(self, other):
+        return isinstance(other, Manifest) and self.routes == other.routes
+
+    def __ne__(self, other):
+        return not self == other
+
+    def timings(self, repeat=100):
+        """Return the mean seconds it takes to resolve each route without
+        regex segments to its Resource, by path. Handlers are not called.
+        """
+        resolver = Resolver(self.root)
+        resolve = resolver.resolve
+        timings = {}
+        for route in self.routes:
+            if '{' in route.path:
+                continue
+            started = default_timer()
+            for _ in range(repeat):
+                resolve(self.root, route.path)
+            timings[route.path] = (default_timer() - started) / repeat
+        return timings
+
+    def to_json(self):
+        return json.dumps([route._asdict() for route in self.routes],
+                          indent=2)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved manifest, for comparison with the current one."""
+        manifest = cls.__new__(cls)
+        manifest.root = None
+        manifest.problems = []
+        manifest.unreachable = []
+        with open(path) as f:
+            manifest.routes = [Route(route['path'], route['kind'],
+                                     route['target'], tuple(route['methods']),
+                                     route['searches'])
+                               for route in json.load(f)]
+        return manifest
+
+
+def load_application(spec):
+    """Import ``module:attribute``, instantiating Resource classes."""
+    module, _, attribute = spec.partition(':')
+    application = getattr(import_module(module), attribute or 'application')
+    if isinstance(application, type) and issubclass(application, Resource):
+        application = application()
+    return application
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='List the routes of a Resource application.')
+    parser.add_argument('application', help='module:attribute')
+    parser.add_argument('--timing', action='store_true',
+                        help='time resolving each literal route')
+    parser.add_argument('--json', metavar='FILE',
+                        help='save the manifest as JSON')
+    args = parser.parse_args(argv)
+
+    manifest = Manifest(load_application(args.application), strict=False)
+    timings = manifest.timings() if args.timing else {}
+
+    for route in manifest:
+        timing = timings.get(route.path)
+        print('%-40s %-28s %3d %9s  %s' % (
+            route.path, ','.join(route.methods), route.searches,
+            '%.1fus' % (timing * 1e6) if timing is not None else '-',
+            route.target))
+    for problem in manifest.problems:
+        print('CONFLICT: %s' % problem)
+    for problem in manifest.unreachable:
+        print('UNREACHABLE: %s' % problem)
+
+    if args.json:
+        manifest.save(args.json)
+    return 1 if manifest.problems or manifest.unreachable else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
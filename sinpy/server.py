@@ -0,0 +1,193 @@
+"""A preforking HTTP server for Resource applications. POSIX only.
+
+    from sinpy.server import PreforkServer
+
+    PreforkServer(Site(), port=8080, workers=4).serve_forever()
+
+The master process binds the listening socket and builds the route
+manifest of the Resource tree, compiling its routing tables and failing
+early on route conflicts. Then it forks the workers, which share all of
+that through copy-on-write. Workers serve requests with wsgiref and are
+restarted when they die, or after ``max_requests`` requests if given.
+
+Signals to the master:
+
+SIGHUP
+    Graceful reload: fork a new set of workers and let the old ones finish
+    the request they are serving.
+SIGTERM, SIGINT
+    Graceful shutdown. Workers still busy after ``graceful_timeout``
+    seconds are killed.
+"""
+import errno
+import gc
+from multiprocessing import cpu_count
+import os
+import signal
+import socket
+from time import sleep, time
+import traceback
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from sinpy import Resource
+from sinpy.manifest import Manifest
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class _WorkerServer(WSGIServer):
+    """WSGIServer on an inherited listening socket, counting requests."""
+    handled = 0
+
+    def __init__(self, sock, handler_class, application, timeout):
+        WSGIServer.__init__(self, sock.getsockname(), handler_class,
+                            bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        host, port = sock.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(application)
+        self.timeout = timeout
+
+    def process_request(self, request, client_address):
+        self.handled += 1
+        WSGIServer.process_request(self, request, client_address)
+
+
+class PreforkServer(object):
+    _POLL_INTERVAL = 0.5
+
+    def __init__(self, application, host='', port=8000, workers=None,
+                 max_requests=None, graceful_timeout=30, backlog=128,
+                 quiet=False):
+        self.application = application
+        self.workers = workers or cpu_count()
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.handler_class = _QuietHandler if quiet else WSGIRequestHandler
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(backlog)
+        # Workers race for connections; the losers must not block in
+        # accept.
+        self.socket.setblocking(False)
+        self.address = self.socket.getsockname()
+
+        self._children = set()
+        self._retiring = {}
+        self._running = False
+        self._reload = False
+
+    def preload(self):
+        """Build the route manifest of the application's Resource tree, so
+        that workers inherit its tables instead of each building their own.
+        """
+        if isinstance(self.application, Resource):
+            self.manifest = Manifest(self.application)
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
+    def serve_forever(self):
+        self.preload()
+        self._running = True
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+
+        try:
+            while self._running:
+                if self._reload:
+                    self._reload = False
+                    self._retire(list(self._children))
+                self._reap()
+                while len(self._children) < self.workers:
+                    self._spawn()
+                sleep(self._POLL_INTERVAL)
+        finally:
+            self._retire(list(self._children))
+            while self._retiring:
+                self._reap()
+                if self._retiring:
+                    sleep(min(self._POLL_INTERVAL, 0.05))
+            self.socket.close()
+
+    def _handle_reload(self, signum, frame):
+        self._reload = True
+
+    def _handle_stop(self, signum, frame):
+        self._running = False
+
+    def _retire(self, pids):
+        deadline = time() + self.graceful_timeout
+        for pid in pids:
+            self._children.discard(pid)
+            self._retiring[pid] = deadline
+            self._kill(pid, signal.SIGTERM)
+
+    def _kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if not pid:
+                break
+            self._children.discard(pid)
+            self._retiring.pop(pid, None)
+
+        now = time()
+        for pid, deadline in list(self._retiring.items()):
+            if now > deadline:
+                self._kill(pid, signal.SIGKILL)
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._children.add(pid)
+            return pid
+
+        status = 0
+        try:
+            self._work()
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _work(self):
+        alive = [True]
+
+        def stop(signum, frame):
+            alive[0] = False
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        server = _WorkerServer(self.socket, self.handler_class,
+                               self.application, self._POLL_INTERVAL)
+        while alive[0] and (self.max_requests is None or
+                            server.handled < self.max_requests):
+            server.handle_request()
+
+
+def serve(application, host='', port=8000, **kwargs):
+    PreforkServer(application, host, port, **kwargs).serve_forever()
@@ -0,0 +1,200 @@
+"""Compiled HTML templates for Resource handlers.
+
+    from sinpy.template import Template
+
+    page = Template('<ul>{% for item in items %}'
+                    '<li>{{ item.name }}</li>{% endfor %}</ul>')
+
+    class Site(Resource):
+        def get(self):
+            self.response.headers['Content-type'] = 'text/html'
+            return page.stream({'items': load_items()})
+
+Templates are compiled once to a Python generator function. ``stream``
+yields the rendered output in chunks, every ``batch`` iterations of a
+``for`` loop and at ``{% flush %}`` tags, so large pages start going out
+before they are fully rendered. ``render`` returns the whole output.
+
+``{{ expression }}`` outputs the value of a Python expression, HTML escaped
+unless it is Markup. ``{% for target in iterable %}``, ``{% if %}``,
+``{% elif %}``, ``{% else %}`` and their ``{% endfor %}`` and ``{% endif %}``
+work like their Python counterparts. ``{# ... #}`` is a comment.
+
+Templates loads template files from a directory and keeps them compiled,
+recompiling files whose mtime changed when created with ``reload=True``.
+"""
+import os.path
+from re import compile as re_compile, DOTALL
+from types import FunctionType
+
+_TOKENS = re_compile(r'(\{\{.*?\}\}|\{%.*?%\}|\{#.*?#\})', DOTALL)
+
+try:
+    _STRING_TYPES = (basestring,)
+except NameError:
+    _STRING_TYPES = (str,)
+
+
+class Markup(str):
+    """A string of HTML that is output without escaping."""
+    __slots__ = ()
+
+
+def escape(value):
+    if isinstance(value, Markup):
+        return value
+    if not isinstance(value, _STRING_TYPES):
+        value = str(value)
+    return (value.replace('&', '&amp;').replace('<', '&lt;')
+                 .replace('>', '&gt;').replace('"', '&quot;')
+                 .replace("'", '&#39;'))
+
+
+class TemplateError(ValueError):
+    pass
+
+
+class Template(object):
+    def __init__(self, source, name='<template>', batch=64):
+        self.name = name
+        self.batch = batch
+        self.source = self._translate(source)
+
+        namespace = {}
+        exec(compile(self.source, name, 'exec'), namespace)
+        self._code = namespace['_render'].__code__
+        self._builtins = namespace['__builtins__']
+
+    def _translate(self, source):
+        """Return the Python source of the generator function for source."""
+        lines = ['def _render(_batch):',
+                 '    _buffer = []',
+                 '    _append = _buffer.append']
+        blocks = []
+        output = []
+        line = 1
+
+        def emit(code, indent=0):
+            lines.append('    ' * (len(blocks) + 1 + indent) + code)
+
+        def emit_output():
+            # Adjacent text and expressions become a single %-format.
+            expressions = [expression for _, expression in output
+                           if expression is not None]
+            if expressions:
+                emit('_append(%r %% (%s,))' % (
+                    ''.join('%s' if expression is not None
+                            else text.replace('%', '%%')
+                            for text, expression in output),
+                    ', '.join(expressions)))
+            elif output:
+                emit('_append(%r)' % ''.join(text for text, _ in output))
+            del output[:]
+
+        def check(code, mode='eval'):
+            try:
+                compile(code, self.name, mode)
+            except SyntaxError as e:
+                raise TemplateError('%s:%d: %s' % (self.name, line, e.msg))
+
+        for token in _TOKENS.split(source):
+            if token.startswith('{{') and token.endswith('}}'):
+                expression = token[2:-2].strip()
+                check(expression)
+                output.append((None, '_escape(%s)' % expression))
+            elif token.startswith('{%') and token.endswith('%}'):
+                emit_output()
+                tag, _, argument = token[2:-2].strip().partition(' ')
+                argument = argument.strip()
+                if tag == 'for':
+                    check('for %s:\n pass' % argument, 'exec')
+                    counter = '_n%d' % len(blocks)
+                    emit('%s = 0' % counter)
+                    emit('for %s:' % argument)
+                    blocks.append(('for', counter))
+                elif tag == 'endfor':
+                    if not blocks or blocks[-1][0] != 'for':
+                        raise TemplateError('%s:%d: unexpected endfor'
+                                            % (self.name, line))
+                    counter = blocks[-1][1]
+                    emit('%s += 1' % counter)
+                    emit('if %s >= _batch:' % counter)
+                    emit('%s = 0' % counter, 1)
+                    emit("yield ''.join(_buffer)", 1)
+                    emit('del _buffer[:]', 1)
+                    blocks.pop()
+                elif tag == 'if':
+                    check(argument)
+                    emit('if %s:' % argument)
+                    blocks.append(('if', None))
+                    emit('pass')
+                elif tag in ('elif', 'else'):
+                    if not blocks or blocks[-1][0] != 'if':
+                        raise TemplateError('%s:%d: unexpected %s'
+                                            % (self.name, line, tag))
+                    if tag == 'elif':
+                        check(argument)
+                        emit('elif %s:' % argument, -1)
+                    else:
+                        emit('else:', -1)
+                    emit('pass')
+                elif tag == 'endif':
+                    if not blocks or blocks[-1][0] != 'if':
+                        raise TemplateError('%s:%d: unexpected endif'
+                                            % (self.name, line))
+                    blocks.pop()
+                elif tag == 'flush':
+                    emit("yield ''.join(_buffer)")
+                    emit('del _buffer[:]')
+                else:
+                    raise TemplateError('%s:%d: unknown tag %r'
+                                        % (self.name, line, tag))
+            elif not (token.startswith('{#') and token.endswith('#}')):
+                if token:
+                    output.append((token, None))
+            line += token.count('\n')
+
+        if blocks:
+            raise TemplateError('%s: %s not closed'
+                                % (self.name, blocks[-1][0]))
+        emit_output()
+        emit("yield ''.join(_buffer)")
+        return '\n'.join(lines) + '\n'
+
+    def stream(self, namespace=None, batch=None):
+        """Render with the names in namespace, yielding the output in
+        chunks. ``batch`` overrides the loop iterations per chunk.
+        """
+        scope = dict(namespace or {})
+        scope['_escape'] = escape
+        scope['__builtins__'] = self._builtins
+        render = FunctionType(self._code, scope)
+        return render(batch or self.batch)
+
+    def render(self, **namespace):
+        return ''.join(self.stream(namespace))
+
+
+class Templates(object):
+    """Compiled templates from the files in ``directory``, by file name."""
+
+    def __init__(self, directory, reload=False, batch=64):
+        self.directory = directory
+        self.reload = reload
+        self.batch = batch
+        self._templates = {}
+
+    def __getitem__(self, name):
+        entry = self._templates.get(name)
+        if entry is not None and not self.reload:
+            return entry[1]
+
+        path = os.path.join(self.directory, name)
+        mtime = os.stat(path).st_mtime
+        if entry is None or entry[0] != mtime:
+            with open(path) as f:
+                entry = (mtime, Template(f.read(), path, self.batch))
+            self._templates[name] = entry
+        return entry[1]
+
+    get = __getitem__
@@ -1,10 +1,24 @@
 from errno import ENOENT
+import os
+from io import BytesIO
 import re
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp, NamedTemporaryFile
+from threading import Event, Thread
+import uuid
+import zlib
 from unittest import TestCase
+from wsgiref.util import FileWrapper
 
-from mock import mock_open, Mock, patch
+from mock import ANY, mock_open, Mock, patch
 
-from sinpy import Dispatcher, get_response, NotFound, Resource, Response, Static
+from sinpy import (AdmissionControl, cached, Coalescing, Compression,
+                   Context, Dispatcher, FLUSH, get_response, Instrumentation,
+                   json_body, NotFound, Request, RequestTooLarge, Resolver,
+                   Resource, Response, ResponseCache, RouteTimings,
+                   SlowestProfiles, Static, StaticCache, Stream, StreamClosed,
+                   Subrequests, SubrequestTimeout)
 
 
 class TestGetResponse(TestCase):
@@ -49,6 +63,92 @@ class TestGetResponse(TestCase):
         self.assertEqual(response,
                          'MOCK NOT FOUND')
 
+    def test_params(self):
+        dispatcher = Dispatcher()
+
+        class Site(Resource):
+            @dispatcher.route('contact/<int:id_>')
+            @Resource
+            def contact(self, id_):
+                return '%r %r' % (id_, self.request.params)
+
+            @dispatcher.route(re=r'page-(?P<number>\d+)')
+            @Resource
+            def page(self):
+                return self.request.params['number']
+
+            @Resource
+            def kwargs(self, **params):
+                return ','.join('%s=%s' % item for item in params.items())
+
+            class Item(Resource):
+                def get(self, name):
+                    return name
+
+            item = Item()
+            dispatcher.route(re=r'item-<slug:name>')(item)
+            dispatcher.route(re=r'all/(?P<sub>.+)')(kwargs)
+
+        self.assertEqual(get_response(Site(), 'GET', '/contact/42').body,
+                         ["42 {'id_': 42}"])
+        self.assertEqual(get_response(Site(), 'GET', '/page-7').body, ['7'])
+        self.assertEqual(get_response(Site(), 'GET', '/item-a-b').body,
+                         ['a-b'])
+        self.assertEqual(get_response(Site(), 'GET', '/all/x/y').body,
+                         ['sub=x/y'])
+        self.assertEqual(get_response(Site(), 'GET', '/contact/x').status_code,
+                         404)
+
+        # Reachable by attribute name, but without the parameters they need.
+        for path in '/contact', '/item':
+            response = get_response(Site(), 'GET', path)
+            self.assertEqual((response.status_code, response.body),
+                             (404, ['Not found']))
+        self.assertEqual(get_response(Site(), 'GET', '/kwargs').body, [''])
+
+    def test_methods(self):
+        class Site(Resource):
+            def get(self):
+                self.response.headers['X-Get'] = 'yes'
+                return 'GET'
+
+            def put(self):
+                return 'PUT'
+
+            @Resource
+            def page(self):
+                return 'PAGE'
+
+            @Resource
+            def stream(self):
+                self.response.headers['X-Stream'] = 'yes'
+                yield 'STREAM'
+
+        response = get_response(Site(), 'DELETE', '/')
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response.headers['Allow'], 'GET, HEAD, PUT, OPTIONS')
+
+        response = get_response(Site(), 'OPTIONS', '/page')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response.headers, {'Allow': 'GET, HEAD, OPTIONS'})
+        self.assertEqual(response.body, [])
+
+        response = get_response(Site(), 'POST', '/page')
+        self.assertEqual(response.status_code, 405)
+
+        response = get_response(Site(), 'PROPFIND', '/nope')
+        self.assertEqual(response.status_code, 404)
+
+        for path, headers in [('/', [('Content-type', 'text/plain'),
+                                     ('X-Get', 'yes'),
+                                     ('Content-Length', '3')]),
+                              ('/stream', [('Content-type', 'text/plain'),
+                                           ('X-Stream', 'yes')])]:
+            start_response = Mock()
+            environ = {'REQUEST_METHOD': 'HEAD', 'PATH_INFO': path}
+            self.assertEqual(list(Site()(environ, start_response)), [])
+            start_response.assert_called_once_with('200 OK', headers)
+
     def test__split_path(self):
         l1l2 = ('level1', 'level2')
         self.assertEqual(get_response._split_path('level1/level2'),
@@ -83,6 +183,166 @@ class TestResponse(TestCase):
         self.response.status_code = 404
         self.assertEqual(self.response.status, '404 NOT FOUND')
 
+        self.response.status_code = 201
+        self.assertEqual(self.response.status, '201 CREATED')
+
+        self.response.status_code = 799
+        self.assertEqual(self.response.status, '799 UNKNOWN')
+
+    def test_multiple_values(self):
+        headers = self.response.headers
+        headers.add('Set-Cookie', 'a=1')
+        headers.add('set-cookie', 'b=2')
+        headers['CONTENT-TYPE'] = 'text/html'
+        headers['Content-Length'] = 10
+
+        self.assertEqual(self.response.headers_list,
+                         [('Set-Cookie', 'a=1'), ('set-cookie', 'b=2'),
+                          ('CONTENT-TYPE', 'text/html'),
+                          ('Content-Length', '10')])
+        self.assertEqual(headers.get_all('Set-Cookie'), ['a=1', 'b=2'])
+        self.assertEqual(headers['content-type'], 'text/html')
+
+        headers['Content-type'] = None
+        self.assertFalse('Content-type' in headers)
+        self.assertEqual(headers.pop('Set-Cookie'), 'a=1')
+        self.assertEqual(len(headers), 1)
+
+    def test_set_content_length(self):
+        self.response.set_content_length(['ab', 'cde'])
+        self.assertEqual(self.response.headers['Content-Length'], '5')
+
+        for status_code, body in [(200, iter(['ab'])), (304, []),
+                                  (200, [None])]:
+            response = Response(status_code)
+            response.set_content_length(body)
+            self.assertFalse('Content-Length' in response.headers)
+
+
+class TestRequest(TestCase):
+    def test_lazy(self):
+        environ = Mock()
+        Request(environ)
+        self.assertEqual(environ.get.call_args_list, [(('PATH_INFO', ''),)])
+
+    def test_environ(self):
+        request = Request({'REQUEST_METHOD': 'POST',
+                           'PATH_INFO': '/path',
+                           'QUERY_STRING': 'a=1&b=&a=2',
+                           'HTTP_COOKIE': 'c=3; d="4"; c=5',
+                           'HTTP_X_FORWARDED_FOR': '127.0.0.1',
+                           'CONTENT_TYPE': 'text/plain',
+                           'CONTENT_LENGTH': ''})
+
+        self.assertEqual(request.method, 'POST')
+        self.assertEqual(request.path, '/path')
+        self.assertEqual(request.query, {'a': ['1', '2'], 'b': ['']})
+        self.assertIs(request.query, request.query)
+        self.assertEqual(request.cookies, {'c': '3', 'd': '4'})
+        self.assertEqual(request.headers,
+                         {'X-Forwarded-For': '127.0.0.1',
+                          'Cookie': 'c=3; d="4"; c=5',
+                          'Content-Type': 'text/plain'})
+        self.assertEqual(request.body.read(), '')
+
+    def test_body(self):
+        request = Request({'CONTENT_LENGTH': '6',
+                           'wsgi.input': BytesIO(b'ABCDEFGHIJ')})
+        self.assertEqual(request.body.read(), 'ABCDEF')
+        self.assertFalse(request.body._rolled)
+
+        request = Request({'wsgi.input': BytesIO(b'ABCDEFGHIJ'),
+                           'wsgi.input_terminated': True})
+        request._SPOOL_SIZE = 4
+        request._BLOCK_SIZE = 3
+        self.assertEqual(request.body.read(), 'ABCDEFGHIJ')
+        self.assertTrue(request.body._rolled)
+
+        request = Request({'wsgi.input': BytesIO(b'ABCDEFGHIJ')})
+        self.assertEqual(request.body.read(), '')
+
+    def test_body_too_large(self):
+        for environ in [{'CONTENT_LENGTH': '11'},
+                        {'wsgi.input_terminated': True}]:
+            environ['wsgi.input'] = BytesIO(b'A' * 11)
+            request = Request(environ)
+            request._MAX_BODY_SIZE = 10
+            with self.assertRaises(RequestTooLarge):
+                request.body
+
+    def test_too_large_response(self):
+        class Site(Resource):
+            def post(self):
+                return self.request.body.read()
+
+            class Stream(Resource):
+                def post(self):
+                    yield self.request.body.read()
+
+            stream = Stream()
+
+        class Compressed(Site):
+            _compression = Compression(min_size=1)
+
+        for site, path in [(Site, '/'), (Site, '/stream'),
+                           (Compressed, '/stream')]:
+            environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': path,
+                       'CONTENT_LENGTH': str(Request._MAX_BODY_SIZE + 1),
+                       'HTTP_ACCEPT_ENCODING': 'gzip',
+                       'wsgi.input': BytesIO()}
+            start_response = Mock()
+            body = list(site()(environ, start_response))
+
+            self.assertEqual(start_response.call_args[0][0],
+                             '413 REQUEST ENTITY TOO LARGE')
+            self.assertEqual(body, ['Request entity too large'])
+
+    def test_form(self):
+        request = Request({'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                           'CONTENT_LENGTH': '7',
+                           'wsgi.input': BytesIO(b'a=1&b=2')})
+        self.assertEqual(request.form, {'a': ['1'], 'b': ['2']})
+
+        body = ('--X\r\nContent-Disposition: form-data; name="a"\r\n\r\n1\r\n'
+                '--X\r\nContent-Disposition: form-data; name="f"; '
+                'filename="f.txt"\r\n\r\nFILE\r\n--X--\r\n')
+        request = Request({'CONTENT_TYPE': 'multipart/form-data; boundary=X',
+                           'CONTENT_LENGTH': str(len(body)),
+                           'wsgi.input': BytesIO(body)})
+        self.assertEqual(request.form['a'], ['1'])
+        self.assertEqual(request.form['f'][0].filename, 'f.txt')
+        self.assertEqual(request.form['f'][0].file.read(), 'FILE')
+
+        self.assertEqual(Request({'CONTENT_TYPE': 'text/plain'}).form, {})
+
+    def test_arguments(self):
+        class Site(Resource):
+            def get(self, var=None):
+                return repr(var)
+
+            post = get
+
+            @Resource
+            def required(self, var):
+                return var
+
+        form = {'REQUEST_METHOD': 'POST', 'QUERY_STRING': 'var=query',
+                'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                'CONTENT_LENGTH': '8', 'wsgi.input': BytesIO(b'var=form')}
+        for environ, body in [({}, "None"),
+                              ({'QUERY_STRING': 'var=1&var=2'}, "'1'"),
+                              (form, "'form'")]:
+            start_response = Mock()
+            environ = dict({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'},
+                           **environ)
+            self.assertEqual(list(Site()(environ, start_response)), [body])
+
+        # Required arguments only come from route parameters.
+        start_response = Mock()
+        Site()({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/required',
+                'QUERY_STRING': 'var=1'}, start_response)
+        self.assertEqual(start_response.call_args[0][0], '404 NOT FOUND')
+
 
 class TestResource(TestCase):
     def test_response_decorator(self):
@@ -116,6 +376,24 @@ class TestResource(TestCase):
         self.assertEqual(get_response(s, 'DELETE', 'level1/level2').body,
                          ['DELETE'])
 
+    def test_bind_shares_state(self):
+        class Site(Resource):
+            @Resource
+            def level1(self):
+                return self
+
+        s = Site()
+        with patch('sinpy.Response') as response:
+            bound = s.level1
+            get_response(s, 'GET', 'level1')
+
+        self.assertEqual(response.call_count, 1)
+        self.assertFalse(isinstance(bound, Resource))
+        self.assertIs(bound.response, s.response)
+        self.assertIs(bound.request, s.request)
+        self.assertEqual(bound, s.level1)
+
+
 @patch('sinpy.get_response')
 class TestResourceWSGI(TestCase):
     def setUp(self):
@@ -131,7 +409,17 @@ class TestResourceWSGI(TestCase):
         self.assertEqual(r, ['RETURN'])
         get_response.assert_called_once_with(self.site,
                                              'REQUEST_METHOD',
-                                             'PATH_INFO')
+                                             'PATH_INFO',
+                                             context=ANY)
+
+    def test___call__content_length(self, get_response):
+        get_response.return_value = Response(body='RETURN')
+
+        list(self.site(self.environ, self.start_response))
+
+        self.start_response.assert_called_once_with(
+            '200 OK', [('Content-type', 'text/plain'),
+                       ('Content-Length', '6')])
 
     def test___call__iter(self, get_response):
         get_response.return_value.body = iter(['RETURN'])
@@ -141,7 +429,8 @@ class TestResourceWSGI(TestCase):
         self.assertEqual(r, ['RETURN'])
         get_response.assert_called_once_with(self.site,
                                              'REQUEST_METHOD',
-                                             'PATH_INFO')
+                                             'PATH_INFO',
+                                             context=ANY)
 
 
 class TestNotFound(TestCase):
@@ -156,11 +445,661 @@ class TestNotFound(TestCase):
         self.assertEqual(r, 'Not found')
 
     def test_post_put_delete(self):
-        for method in ['post', 'put', 'delete']:
+        for method in ['post', 'put', 'patch', 'delete', 'options']:
             self.assertEqual(getattr(self.nf, method),
                              self.nf.get)
 
 
+class TestContext(TestCase):
+    def test_current(self):
+        class Site(Resource):
+            def get(self):
+                return self.response
+
+        site = Site()
+        context = Context()
+        self.assertIsNot(site.response, context.response)
+
+        with context:
+            self.assertIs(Context.current(), context)
+            self.assertIs(site.response, context.response)
+            self.assertIs(site.request, context.request)
+        self.assertIs(Context.current(), None)
+
+        response = get_response(site, 'GET', '', context=context)
+        self.assertIs(response, context.response)
+        self.assertEqual(response.body, [context.response])
+
+    def test_application(self):
+        class Site(Resource):
+            def get(self):
+                yield self.request.path
+                yield str(Context.current() is not None)
+
+        r = list(Site()({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'},
+                        Mock()))
+
+        self.assertEqual(r, ['/', 'True'])
+        self.assertIs(Context.current(), None)
+
+
+class TestCompression(TestCase):
+    def setUp(self):
+        class Site(Resource):
+            _compression = Compression(min_size=10)
+
+            def get(self):
+                self.response.headers['Content-type'] = 'text/html'
+                for i in range(5):
+                    yield '<p>%d</p>' % i
+
+            @Resource
+            def small(self):
+                return 'SMALL'
+
+            @Resource
+            def large(self):
+                return 'LARGE' * 10
+
+            @Resource
+            def image(self):
+                self.response.headers['Content-type'] = 'image/png'
+                return 'PNG' * 10
+
+        self.site = Site()
+
+    def request(self, path, accept='gzip'):
+        start_response = Mock()
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+                   'HTTP_ACCEPT_ENCODING': accept}
+        body = ''.join(self.site(environ, start_response))
+        status, headers = start_response.call_args[0]
+        return dict(headers), body
+
+    def test_compressed(self):
+        for path, expected in [('/', ''.join('<p>%d</p>' % i
+                                             for i in range(5))),
+                               ('/large', 'LARGE' * 10)]:
+            headers, body = self.request(path)
+            self.assertEqual(headers['Content-Encoding'], 'gzip')
+            self.assertEqual(headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS),
+                             expected)
+
+    def test_not_compressed(self):
+        for path, accept, expected in [('/', 'identity', None),
+                                       ('/small', 'gzip', 'SMALL'),
+                                       ('/image', 'gzip', 'PNG' * 10),
+                                       ('/large', 'gzip;q=0', 'LARGE' * 10)]:
+            headers, body = self.request(path, accept)
+            self.assertFalse('Content-Encoding' in headers)
+            if expected is not None:
+                self.assertEqual(body, expected)
+
+        headers, body = self.request('/small')
+        self.assertEqual(headers['Content-Length'], '5')
+
+    def test_flush(self):
+        class Site(Resource):
+            _compression = Compression(min_size=1000)
+            _coalescing = Coalescing(max_bytes=1000)
+
+            def get(self):
+                self.response.headers['Content-type'] = 'text/plain'
+                yield 'FIRST'
+                yield FLUSH
+                yield 'SECOND'
+
+        start_response = Mock()
+        body = list(Site()({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/',
+                            'HTTP_ACCEPT_ENCODING': 'gzip'}, start_response))
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        self.assertEqual(dict(start_response.call_args[0][1])
+                         ['Content-Encoding'], 'gzip')
+        self.assertEqual(decompressor.decompress(body[0]), 'FIRST')
+        self.assertEqual(decompressor.decompress(body[1]), 'SECOND')
+
+
+class TestCoalescing(TestCase):
+    def test_max_bytes(self):
+        coalescing = Coalescing(max_bytes=4, max_delay=60)
+        self.assertEqual(list(coalescing(['a', 'bc', '', 'd', 'efgh', 'i'])),
+                         ['abcd', 'efgh', 'i'])
+
+    def test_flush(self):
+        coalescing = Coalescing(max_bytes=100, max_delay=60)
+        self.assertEqual(list(coalescing([FLUSH, 'a', 'b', FLUSH, FLUSH,
+                                          'c'])),
+                         ['ab', 'c'])
+
+    @patch('sinpy.time')
+    def test_max_delay(self, time):
+        time.side_effect = [0, 0, 0.5, 1, 1, 1.1, 1.2]
+        coalescing = Coalescing(max_bytes=100, max_delay=1)
+        self.assertEqual(list(coalescing(['a', 'b', 'c', 'd', 'e'])),
+                         ['abc', 'de'])
+
+    def test_application(self):
+        class Site(Resource):
+            def get(self):
+                for part in '<ul>', '<li>1</li>', '<li>2</li>', FLUSH, '</ul>':
+                    yield part
+
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'}
+        self.assertEqual(list(Site()(environ, Mock())),
+                         ['<ul>', '<li>1</li>', '<li>2</li>', '</ul>'])
+
+        Site._coalescing = Coalescing(max_bytes=100)
+        self.assertEqual(list(Site()(environ, Mock())),
+                         ['<ul><li>1</li><li>2</li>', '</ul>'])
+
+
+class TestAdmissionControl(TestCase):
+    def environ(self, path='/'):
+        return {'REQUEST_METHOD': 'GET', 'PATH_INFO': path}
+
+    def test_limits(self):
+        admission = AdmissionControl(max_in_flight=2, prefixes={'/api': 1,
+                                                                '/api/v2': 2},
+                                     max_wait=0)
+        api = admission.acquire('/api/users')
+        self.assertIsNone(admission.acquire('/api/items'))
+        v2 = admission.acquire('/api/v2/items')
+        self.assertIsNone(admission.acquire('/'))
+        self.assertEqual(admission.counters(),
+                         {'in_flight': 2, 'queued': 0, 'admitted': 2,
+                          'rejected': 2, 'wait_time': 0.0, 'latency': 0.0,
+                          'prefixes': {'/api': 1, '/api/v2': 1}})
+
+        admission.release(api)
+        admission.release(v2)
+        self.assertEqual(admission.in_flight, 0)
+        self.assertIsNotNone(admission.acquire('/api/users'))
+
+    def test_wait(self):
+        admission = AdmissionControl(max_in_flight=1, max_wait=5)
+        ticket = admission.acquire('/')
+        admitted = []
+        thread = Thread(target=lambda: admitted.append(
+            admission.acquire('/')))
+        thread.start()
+        while not admission.queued:
+            thread.join(0.01)
+        admission.release(ticket)
+        thread.join()
+
+        self.assertIsNotNone(admitted[0])
+        self.assertEqual(admission.admitted, 2)
+        self.assertGreater(admission.wait_time, 0)
+
+    @patch('sinpy.monotonic')
+    def test_latency_target(self, monotonic):
+        monotonic.side_effect = [0, 10, 10]
+        admission = AdmissionControl(max_in_flight=1, max_wait=5,
+                                     latency_target=1)
+        ticket = admission.acquire('/')
+        admission.record(ticket)
+        self.assertEqual(admission.latency, 2)
+
+        # Over the target, requests that would have to wait are shed.
+        self.assertIsNone(admission.acquire('/'))
+        self.assertEqual(admission.queued, 0)
+
+        # Without limits no request ever waits, so none would be shed.
+        with self.assertRaises(ValueError):
+            AdmissionControl(latency_target=1)
+        AdmissionControl(prefixes={'/api': 1}, latency_target=1)
+
+    def test_application(self):
+        class Site(Resource):
+            _admission = AdmissionControl(max_in_flight=1, max_wait=0,
+                                          retry_after=3)
+
+            def get(self):
+                yield 'OK'
+
+        site = Site()
+        body = site(self.environ(), Mock())
+        self.assertEqual(Site._admission.in_flight, 1)
+
+        start_response = Mock()
+        self.assertEqual(list(site(self.environ(), start_response)),
+                         [b'Service unavailable, retry later'])
+        start_response.assert_called_once_with(
+            '503 SERVICE UNAVAILABLE',
+            [('Content-type', 'text/plain'), ('Content-Length', '32'),
+             ('Retry-After', '3')])
+
+        self.assertEqual(list(body), ['OK'])
+        body.close()
+        self.assertEqual(Site._admission.in_flight, 0)
+
+        # Bodies closed before their first iteration release their slot.
+        site(self.environ(), Mock()).close()
+        self.assertEqual(Site._admission.in_flight, 0)
+
+    def test_application_bodies(self):
+        class Site(Resource):
+            _admission = AdmissionControl(max_in_flight=2, max_wait=0)
+
+            def get(self):
+                return ['OK']
+
+            @Resource
+            def events(self):
+                return Stream(iter(['a', 'b']))
+
+        site = Site()
+        self.assertEqual(site(self.environ(), Mock()), ['OK'])
+        self.assertEqual(Site._admission.in_flight, 0)
+
+        body = site(self.environ('/events'), Mock())
+        self.assertEqual(list(body), ['a', 'b'])
+        self.assertEqual(Site._admission.in_flight, 1)
+        body.close()
+        self.assertEqual(Site._admission.in_flight, 0)
+
+        # Servers only send file_wrapper objects directly if they get them.
+        with NamedTemporaryFile() as f:
+            f.write(b'FILE')
+            f.flush()
+            Site.static = Static(f.name)
+            environ = dict(self.environ('/static'),
+                           **{'wsgi.file_wrapper': FileWrapper})
+            body = site(environ, Mock())
+            self.assertIsInstance(body, FileWrapper)
+            self.assertEqual(Site._admission.in_flight, 1)
+            self.assertEqual(list(body), [b'FILE'])
+            body.close()
+            body.close()
+            self.assertEqual(Site._admission.in_flight, 0)
+
+
+class TestStream(TestCase):
+    def test_producer(self):
+        stream = Stream(max_buffer=2)
+        put = []
+
+        def produce():
+            try:
+                for chunk in 'a', 'b', FLUSH, 'c', 'd':
+                    stream.put(chunk)
+                    put.append(chunk)
+            finally:
+                stream.finish()
+
+        producer = Thread(target=produce)
+        producer.start()
+        producer.join(0.1)
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(put, ['a', 'b'])
+
+        self.assertEqual(list(stream), ['a', 'b', 'c', 'd'])
+        producer.join()
+
+    def test_cancel(self):
+        on_cancel = Mock()
+        stream = Stream(max_buffer=1, on_cancel=on_cancel)
+        errors = []
+
+        def produce():
+            try:
+                while True:
+                    stream.put('chunk')
+            except StreamClosed as e:
+                errors.append(e)
+
+        producer = Thread(target=produce)
+        producer.start()
+        self.assertEqual(next(stream), 'chunk')
+        stream.close()
+        producer.join()
+
+        self.assertEqual(len(errors), 1)
+        on_cancel.assert_called_once_with(stream)
+
+    def test_generator(self):
+        closed = []
+
+        class Site(Resource):
+            def get(self):
+                def chunks():
+                    try:
+                        yield self.request.method
+                        yield FLUSH
+                        yield 'b'
+                    finally:
+                        closed.append(True)
+                return Stream(chunks(), on_cancel=closed.append)
+
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'}
+        body = Site()(environ, Mock())
+        self.assertEqual(list(body), ['GET', 'b'])
+        body.close()
+        self.assertEqual(closed, [True])
+
+        body = Site()(environ, Mock())
+        self.assertEqual(next(body), 'GET')
+        body.close()
+        self.assertEqual(closed, [True, True, body])
+
+
+class TestJSONBody(TestCase):
+    def test_value(self):
+        with Context() as context:
+            self.assertEqual(json_body({'a': [1, None]}), ['{"a":[1,null]}'])
+            self.assertEqual(context.response.headers['Content-type'],
+                             'application/json')
+            self.assertEqual(json_body('x', ndjson=True), ['"x"\n'])
+            self.assertEqual(context.response.headers['Content-type'],
+                             'application/x-ndjson')
+
+    def test_array(self):
+        with Context():
+            self.assertEqual(list(json_body([1, 2, 3], batch_size=2)),
+                             ['[1,2', ',3', ']'])
+            self.assertEqual(list(json_body(())), ['[]'])
+            self.assertEqual(list(json_body(iter([{'a': 1}]))),
+                             ['[{"a":1}', ']'])
+
+    def test_ndjson(self):
+        with Context():
+            self.assertEqual(list(json_body([1, {'b': 2}, 3], ndjson=True,
+                                            batch_size=2)),
+                             ['1\n{"b":2}\n', '3\n'])
+            self.assertEqual(list(json_body([], ndjson=True)), [])
+
+    def test_default(self):
+        with Context():
+            self.assertEqual(list(json_body([uuid.UUID(int=1)], default=str)),
+                             ['["00000000-0000-0000-0000-000000000001"', ']'])
+
+    def test_generator(self):
+        closed = []
+
+        def records():
+            try:
+                for i in range(10):
+                    yield {'id': i}
+            finally:
+                closed.append(True)
+
+        class Site(Resource):
+            def get(self):
+                return json_body(records(), batch_size=4)
+
+        start_response = Mock()
+        body = Site()({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'},
+                      start_response)
+        self.assertEqual(next(body), '[{"id":0},{"id":1},{"id":2},{"id":3}')
+        start_response.assert_called_once_with(
+            '200 OK', [('Content-type', 'application/json')])
+
+        body.close()
+        self.assertEqual(closed, [True])
+
+
+class TestSubrequests(TestCase):
+    def setUp(self):
+        self.release = Event()
+
+        class Site(Resource):
+            @Resource
+            def fast(self):
+                return self.request.query['name'][0]
+
+            @Resource
+            def slow(inner):
+                self.release.wait(5)
+                return 'SLOW'
+
+            @Resource
+            def cookie(self):
+                yield self.request.cookies.get('session', '')
+                yield FLUSH
+
+            @Resource
+            def broken(self):
+                raise KeyError('broken')
+
+        self.subrequests = Subrequests(Site(), max_workers=4)
+
+    def tearDown(self):
+        self.release.set()
+
+    def test_run(self):
+        results = self.subrequests.run(['slow', '/fast?name=FAST'])
+        fast = next(results)
+        self.assertEqual((fast.path, fast.status_code, fast.body),
+                         ('/fast?name=FAST', 200, 'FAST'))
+
+        self.release.set()
+        slow = next(results)
+        self.assertEqual((slow.path, slow.body), ('slow', 'SLOW'))
+        self.assertRaises(StopIteration, next, results)
+
+    def test_isolation(self):
+        environ = {'HTTP_COOKIE': 'session=abc', 'wsgi.input': BytesIO()}
+        with Context(Request(environ)) as context:
+            results = list(self.subrequests.run(['cookie', 'fast?name=A',
+                                                 'fast?name=B', 'missing']))
+            self.assertIs(Context.current(), context)
+
+        self.assertEqual(sorted((result.path, result.status_code, result.body)
+                                for result in results),
+                         [('cookie', 200, 'abc'), ('fast?name=A', 200, 'A'),
+                          ('fast?name=B', 200, 'B'),
+                          ('missing', 404, 'Not found')])
+
+    def test_errors(self):
+        broken = self.subrequests.get('broken')
+        self.assertIsNone(broken.response)
+        self.assertIsInstance(broken.error, KeyError)
+
+        slow = self.subrequests.get('slow', timeout=0.01)
+        self.assertIsNone(slow.response)
+        self.assertIsInstance(slow.error, SubrequestTimeout)
+
+
+class TestInstrumentation(TestCase):
+    def setUp(self):
+        class Site(Resource):
+            def get(self):
+                return 'ROOT'
+
+            @Resource
+            def stream(self):
+                yield 'STREAM'
+
+        self.Site = Site
+        self.recorder = Site._instrumentation = Mock(spec=Instrumentation)
+
+    def events(self):
+        return [name for name, _, _ in self.recorder.method_calls]
+
+    def test_events(self):
+        site = self.Site()
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'}
+        self.assertEqual(site(environ, Mock()), ['ROOT'])
+        self.assertEqual(self.events(), ['resolve_start', 'resolve_end',
+                                         'handler_end', 'first_byte',
+                                         'last_byte'])
+
+        context, timestamp = self.recorder.handler_end.call_args[0]
+        self.assertIs(context.target, site)
+        self.assertEqual(context.timings['handler_end'], timestamp)
+
+    def test_stream_events(self):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/stream'}
+        body = self.Site()(environ, Mock())
+        self.assertEqual(self.events(), ['resolve_start', 'resolve_end',
+                                         'handler_end'])
+        self.assertEqual(list(body), ['STREAM'])
+        self.assertEqual(self.events()[3:], ['first_byte', 'last_byte'])
+
+    @patch('sinpy.monotonic')
+    def test_route_timings(self, monotonic):
+        monotonic.side_effect = [0, 0.001, 0.002, 0.003, 0.003,
+                                 1, 1.001, 1.1, 1.2, 1.2]
+        timings = self.Site._instrumentation = RouteTimings(buckets=(0.01, 1))
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'}
+        self.Site()(environ, Mock())
+        self.Site()(environ, Mock())
+
+        histogram = timings.routes()['GET test.Site']
+        self.assertEqual(histogram.counts, [1, 1, 0])
+        self.assertEqual(histogram.percentile(50), 0.01)
+        self.assertAlmostEqual(histogram.percentile(99), 0.2)
+        self.assertAlmostEqual(histogram.mean, 0.1015)
+        self.assertAlmostEqual(histogram.phases['handler'], 0.1)
+
+    def test_slowest_profiles(self):
+        profiles = self.Site._instrumentation = SlowestProfiles(keep=1,
+                                                                sample_rate=1)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/stream'}
+        list(self.Site()(environ, Mock()))
+        list(self.Site()(environ, Mock()))
+
+        (duration, method, path, stats), = profiles.profiles()
+        self.assertEqual((method, path), ('GET', '/stream'))
+        self.assertTrue(stats.total_calls)
+
+    def test_slowest_profiles_error(self):
+        class Site(Resource):
+            _instrumentation = SlowestProfiles(sample_rate=1)
+
+            def get(self):
+                raise KeyError('broken')
+
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'}
+        self.assertRaises(KeyError, Site(), environ, Mock())
+        self.assertIsNone(sys.getprofile())
+        self.assertEqual(len(Site._instrumentation.profiles()), 1)
+
+
+class TestResponseCache(TestCase):
+    def setUp(self):
+        calls = self.calls = []
+
+        class Site(Resource):
+            @cached(60)
+            def get(self):
+                calls.append(self.request.path)
+                return 'ROOT %d' % len(calls)
+
+            def post(self):
+                calls.append('POST')
+                return 'POST'
+
+            @cached(60)
+            @Resource
+            def page(self):
+                calls.append(self.request.path)
+                yield 'PAGE'
+
+            @Resource
+            def uncached(self):
+                calls.append(self.request.path)
+                return 'UNCACHED'
+
+            @cached(60)
+            @Resource
+            def cookie(self):
+                calls.append(self.request.path)
+                self.response.headers.add('Set-Cookie', 'a=1')
+                return 'COOKIE'
+
+        self.cache = ResponseCache(Site(), max_entries=2)
+
+    def request(self, path, method='GET', **environ):
+        environ.update(REQUEST_METHOD=method, PATH_INFO=path)
+        start_response = Mock()
+        body = ''.join(self.cache(environ, start_response))
+        status, headers = start_response.call_args[0][:2]
+        return status, dict(headers), body
+
+    def test_hit(self):
+        status, headers, body = self.request('/')
+        self.assertEqual(headers['Cache-Control'], 'max-age=60')
+        self.assertEqual(self.request('/'), (status, headers, body))
+        self.assertEqual(self.request('/', 'HEAD'), (status, headers, ''))
+        self.assertEqual(self.request('/page')[2], 'PAGE')
+        self.assertEqual(self.request('/page')[2], 'PAGE')
+
+        self.assertEqual(self.calls, ['/', '/page'])
+        self.assertEqual((self.cache.hits, self.cache.misses), (3, 2))
+        self.assertEqual(self.cache.hit_ratio, 0.6)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_not_cached(self):
+        for path in '/uncached', '/cookie', '/missing':
+            self.request(path)
+            self.request(path)
+        self.request('/', 'POST')
+        self.request('/', 'HEAD')
+
+        self.assertEqual(self.calls, ['/uncached', '/uncached',
+                                      '/cookie', '/cookie', 'POST', '/'])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_key(self):
+        self.request('/', QUERY_STRING='a=1')
+        self.request('/', QUERY_STRING='a=2')
+        self.request('/', HTTP_ACCEPT_ENCODING='gzip')
+        self.request('/', HTTP_ACCEPT_ENCODING='gzip', HTTP_COOKIE='a')
+
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(len(self.cache), 2)
+
+    @patch('sinpy.time')
+    def test_expired(self, time):
+        time.return_value = 0
+        self.request('/')
+        time.return_value = 59
+        self.assertEqual(self.request('/')[2], 'ROOT 1')
+        time.return_value = 60
+        self.assertEqual(self.request('/')[2], 'ROOT 2')
+
+    def test_max_bytes(self):
+        self.cache.max_bytes = 10
+        self.request('/page')
+        self.request('/page')
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.cache.size, 0)
+
+    def test_stampede(self):
+        from threading import Event, Thread
+
+        started, release = Event(), Event()
+        responses = []
+
+        def application(environ, start_response):
+            self.calls.append(environ['PATH_INFO'])
+            started.set()
+            release.wait(5)
+            start_response('200 OK', [('Cache-Control', 'max-age=60')])
+            return ['SLOW']
+
+        self.cache.application = application
+
+        def request():
+            responses.append(self.request('/slow')[2])
+
+        threads = [Thread(target=request) for _ in range(3)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(responses, ['SLOW'] * 3)
+        self.assertEqual(self.calls, ['/slow'])
+
+
 class TestThreadSafe(TestCase):
     def test(self):
         from multiprocessing.pool import ThreadPool
@@ -233,10 +1172,148 @@ class TestDispatcher(TestCase):
         self.assertEqual(dispatcher.get(c, '_C__notprivate'), (c.member1, {}))
         self.assertEqual(dispatcher.get(c, '_notprivate'), (c.member1, {}))
 
+    def test_get_shared_group_names(self):
+        class C(object):
+            member1 = lambda: 1
+            member2 = lambda: 2
+        c = C()
+
+        dispatcher = Dispatcher()
+        dispatcher.route(re=r'a(?P<id>\d)')(C.member1)
+        dispatcher.route(re=r'b(?P<id>\d)')(C.member2)
+
+        self.assertEqual(dispatcher.get(c, 'a1'), (c.member1, {'id': '1'}))
+        self.assertEqual(dispatcher.get(c, 'b2'), (c.member2, {'id': '2'}))
+
+    def test_route_converters(self):
+        class C(object):
+            member1 = lambda: 1
+            member2 = lambda: 2
+            member3 = lambda: 3
+        c = C()
+
+        dispatcher = Dispatcher()
+        dispatcher.route('user.<int:id>/<slug:name>.html')(C.member1)
+        dispatcher.route(re=r'(?P<kind>[ab])-<uuid:key>')(C.member2)
+        dispatcher.route('files/<path:name>')(C.member3)
+
+        self.assertEqual(dispatcher.get(c, 'user.5/a-b.html'),
+                         (c.member1, {'id': 5, 'name': 'a-b'}))
+        self.assertEqual(dispatcher.get(c, 'userx5/a-b.html', 'DEFAULT'),
+                         ('DEFAULT', {}))
+        key = '12345678-1234-1234-1234-123456789abc'
+        self.assertEqual(dispatcher.get(c, 'a-' + key),
+                         (c.member2, {'kind': 'a', 'key': uuid.UUID(key)}))
+        self.assertEqual(dispatcher.get(c, 'files/a/b.txt'),
+                         (c.member3, {'name': 'a/b.txt'}))
+
+        with self.assertRaises(ValueError):
+            dispatcher.route('<float:x>')
+
+    def test_get_many_patterns(self):
+        dispatcher = Dispatcher()
+        members = {}
+        for i in range(150):
+            members['member%d' % i] = lambda: None
+            dispatcher.route(re=r'item%d-(?P<id>\d+)' % i)(
+                members['member%d' % i])
+        C = type('C', (object,), members)
+        c = C()
+
+        self.assertEqual(dispatcher.get(c, 'item149-7'),
+                         (c.member149, {'id': '7'}))
+
+        # Combined in alternations of at most 99 groups each.
+        table = dispatcher.table(C)
+        self.assertEqual(len(table.chunks), 4)
+        self.assertEqual(table.sequential, [])
+        self.assertEqual(dispatcher.get(c, 'item50-1'),
+                         (c.member50, {'id': '1'}))
+
+    def test_get_invalidated(self):
+        class Site(Resource):
+            pass
+        site = Site()
+
+        dispatcher = Dispatcher()
+        self.assertEqual(dispatcher.get(site, 'custom', 'DEFAULT'),
+                         ('DEFAULT', {}))
+
+        Site.member = Resource()
+        dispatcher.route('custom')(Site.member)
+        self.assertEqual(dispatcher.get(site, 'custom'), (Site.member, {}))
+
+        Site.other = Resource()
+        Site.other._sp_custom_routes.append('other route')
+        self.assertEqual(dispatcher.get(site, 'other route'),
+                         (Site.other, {}))
+
+
+class TestResolver(TestCase):
+    def setUp(self):
+        dispatcher = Dispatcher()
+
+        class Site(Resource):
+            level1 = Resource()
+            level1.level2 = Resource()
+            level1.level2.get = lambda: 'LEVEL2'
+
+            class Item(Resource):
+                def get(self):
+                    return 'ITEM'
+
+                @Resource
+                def detail(self, id):
+                    return 'DETAIL %d' % id
+
+            item = Item()
+            dispatcher.route(re=r'item<int:id>')(item)
+
+            @dispatcher.route(re=r'files/(?P<name>.+)')
+            @Resource
+            def files(self):
+                return 'FILES'
+
+            def get(self):
+                return 'ROOT'
+        setattr(Site, 'full/path', Site.level1.level2)
+
+        self.site = Site()
+        self.resolver = Resolver(self.site)
+
+    def test_resolve(self):
+        for path in ['level1/level2', '/level1/level2/', 'full/path']:
+            target, params = self.resolver.resolve(self.site, path)
+            self.assertEqual(target, self.site.level1.level2)
+            self.assertEqual(params, {})
+
+    def test_resolve_params(self):
+        target, params = self.resolver.resolve(self.site, 'item42/detail')
+        self.assertEqual(target.get(**params), 'DETAIL 42')
+        self.assertEqual(params, {'id': 42})
+
+        target, params = self.resolver.resolve(self.site, 'files/a/b.txt')
+        self.assertEqual(target.get(), 'FILES')
+        self.assertEqual(params, {'name': 'a/b.txt'})
+
+    def test_resolve_not_found(self):
+        self.assertEqual(self.resolver.resolve(self.site, 'level1/nope'), None)
+        self.assertEqual(self.resolver.resolve(self.site, 'full'), None)
+
+    def test_call(self):
+        for path in ['', 'level1/level2', 'full/path', 'item1',
+                     'item1/detail', 'files/x', 'nope']:
+            expected = get_response(self.site, 'GET', path)
+            expected = (expected.status_code, list(expected.body))
+            response = self.resolver(self.site, 'GET', path)
+            self.assertEqual((response.status_code, list(response.body)),
+                             expected)
+
 
 class TestStatic(TestCase):
+    @patch('os.fstat', return_value=Mock(st_size=13, st_mtime=0))
     @patch('os.path.isdir', return_value=False)
-    def test_static_file(self, isdir):
+    def test_static_file(self, isdir, fstat):
         s = Static('path')
         with patch('sinpy.open', mock_open(read_data='FILE CONTENTS'),
                    create=True) as m:
@@ -263,19 +1340,178 @@ class TestStatic(TestCase):
                 m.side_effect = IOError(-5, None, None)
                 list(s.get())
 
+    @patch('os.fstat', return_value=Mock(st_size=13, st_mtime=0))
     @patch('os.path.isdir', return_value=False)
-    def test_content_type(self, isdir):
+    def test_content_type(self, isdir, fstat):
         s = Static('path.css')
         with patch('sinpy.open', mock_open(), create=True) as m:
             r = list(s.get())
 
-        self.assertEqual(s.response.headers, {'Content-type': 'text/css'})
+        self.assertEqual(s.response.headers,
+                         {'Content-type': 'text/css',
+                          'Content-Length': '13',
+                          'ETag': '"0-d"',
+                          'Last-Modified': 'Thu, 01 Jan 1970 00:00:00 GMT',
+                          'Accept-Ranges': 'bytes'})
+
+    def test_chunked(self):
+        data = ''.join(chr(i % 256) for i in range(Static._BLOCK_SIZE * 2 + 1))
+        with NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            r = list(Static(f.name).get())
+
+        self.assertEqual([len(block) for block in r],
+                         [Static._BLOCK_SIZE, Static._BLOCK_SIZE, 1])
+        self.assertEqual(''.join(r), data)
+
+    @patch('os.fstat', return_value=Mock(st_size=13, st_mtime=0))
+    @patch('os.path.isdir', return_value=False)
+    def test_file_wrapper(self, isdir, fstat):
+        class Site(Resource):
+            static = Static('path')
+
+        wrapped = ['WRAPPED']
+        file_wrapper = Mock(return_value=wrapped)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/path',
+                   'wsgi.file_wrapper': file_wrapper}
+        with patch('sinpy.open', mock_open(), create=True) as m:
+            r = Site()(environ, Mock())
+
+        self.assertIs(r, wrapped)
+        file_wrapper.assert_called_once_with(m.return_value, Static._BLOCK_SIZE)
+
+    def get_file(self, **environ):
+        with NamedTemporaryFile() as f:
+            f.write('0123456789')
+            f.flush()
+            os.utime(f.name, (0, 0))
+
+            s = Static(f.name)
+            s.request = Request(environ)
+            return s.response, ''.join(s.get())
+
+    def test_not_modified(self):
+        for environ in [{'HTTP_IF_NONE_MATCH': '"1", "0-a"'},
+                        {'HTTP_IF_NONE_MATCH': '*'},
+                        {'HTTP_IF_MODIFIED_SINCE':
+                         'Thu, 01 Jan 1970 00:00:00 GMT'}]:
+            response, body = self.get_file(**environ)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers,
+                             {'ETag': '"0-a"',
+                              'Last-Modified': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+            self.assertEqual(body, '')
 
+        for environ in [{'HTTP_IF_NONE_MATCH': '"0-b"'},
+                        {'HTTP_IF_NONE_MATCH': '"0-b"',
+                         'HTTP_IF_MODIFIED_SINCE':
+                         'Thu, 01 Jan 1970 00:00:00 GMT'},
+                        {'HTTP_IF_MODIFIED_SINCE': 'garbage'}]:
+            response, body = self.get_file(**environ)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(body, '0123456789')
+
+    def test_range(self):
+        for header, content_range, expected in [
+                ('bytes=2-4', 'bytes 2-4/10', '234'),
+                ('bytes=7-', 'bytes 7-9/10', '789'),
+                ('bytes=-3', 'bytes 7-9/10', '789'),
+                ('bytes=8-100', 'bytes 8-9/10', '89'),
+                ('bytes=20-30, 1-1', 'bytes 1-1/10', '1')]:
+            response, body = self.get_file(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.headers['Content-Range'], content_range)
+            self.assertEqual(response.headers['Content-Length'],
+                             str(len(expected)))
+            self.assertEqual(body, expected)
+
+    def test_range_ignored(self):
+        for environ in [{'HTTP_RANGE': 'bytes=5-2'},
+                        {'HTTP_RANGE': 'lines=1-2'},
+                        {'HTTP_RANGE': 'bytes=a-b'},
+                        {'HTTP_RANGE': 'bytes=1-2', 'HTTP_IF_RANGE': '"0-b"'},
+                        {'HTTP_RANGE': 'bytes=1-2', 'HTTP_IF_RANGE':
+                         'Thu, 01 Jan 1970 00:00:01 GMT'}]:
+            response, body = self.get_file(**environ)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(body, '0123456789')
+
+        response, body = self.get_file(HTTP_RANGE='bytes=1-2',
+                                       HTTP_IF_RANGE='"0-a"')
+        self.assertEqual(response.status_code, 206)
+
+    def test_range_not_satisfiable(self):
+        for header in 'bytes=10-20', 'bytes=10-', 'bytes=15-':
+            response, body = self.get_file(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response.headers['Content-Range'], 'bytes */10')
+            self.assertEqual(body, '')
+
+    def test_multipart_range(self):
+        response, body = self.get_file(HTTP_RANGE='bytes=0-1,-2')
+        content_type = response.headers['Content-type']
+        boundary = content_type.split('boundary=')[1]
+
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(content_type.startswith('multipart/byteranges;'))
+        self.assertEqual(body,
+                         '--%(b)s\r\nContent-type: application/octet-stream\r\n'
+                         'Content-Range: bytes 0-1/10\r\n\r\n01\r\n'
+                         '--%(b)s\r\nContent-type: application/octet-stream\r\n'
+                         'Content-Range: bytes 8-9/10\r\n\r\n89\r\n'
+                         '--%(b)s--\r\n' % {'b': boundary})
+        self.assertEqual(response.headers['Content-Length'], str(len(body)))
+
+    def test_precompressed(self):
+        directory = mkdtemp()
+        try:
+            for name, data in [('style.css', 'PLAIN'),
+                               ('style.css.gz', 'GZIP'),
+                               ('style.css.br', 'BROTLI')]:
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write(data)
+
+            s = Static(os.path.join(directory, 'style.css'))
+            for accept, body, encoding in [('', 'PLAIN', None),
+                                           ('gzip', 'GZIP', 'gzip'),
+                                           ('gzip, br;q=0', 'GZIP', 'gzip'),
+                                           ('br, gzip', 'BROTLI', 'br'),
+                                           ('*', 'BROTLI', 'br'),
+                                           ('identity', 'PLAIN', None)]:
+                with Context(Request({'HTTP_ACCEPT_ENCODING': accept})):
+                    self.assertEqual(''.join(s.get()), body)
+                    headers = s.response.headers
+                    self.assertEqual(headers['Content-type'], 'text/css')
+                    self.assertEqual(headers.get('Content-Encoding'), encoding)
+                    self.assertEqual(encoding is None,
+                                     'Vary' not in headers)
+
+            s = Static(os.path.join(directory, 'style.css'),
+                       precompressed=False)
+            with Context(Request({'HTTP_ACCEPT_ENCODING': 'gzip'})):
+                self.assertEqual(''.join(s.get()), 'PLAIN')
+
+            # Files under a directory are typed by their own name.
+            class Site(Resource):
+                files = Static(directory)
+
+            for accept, encoding in ('', None), ('gzip', 'gzip'):
+                response = get_response(
+                    Site(), 'GET', '/files/style.css',
+                    context=Context(Request({'HTTP_ACCEPT_ENCODING': accept})))
+                self.assertEqual(response.headers['Content-type'], 'text/css')
+                self.assertEqual(response.headers.get('Content-Encoding'),
+                                 encoding)
+        finally:
+            rmtree(directory)
+
+    @patch('os.stat', return_value=Mock(st_mtime=0))
     @patch('os.path.isdir', return_value=True)
     @patch('os.listdir', return_value=['path1', 'path2', 'path3'])
-    def test_dir(self, lsitdir, isdir):
+    def test_dir(self, lsitdir, isdir, stat):
         s = Static('dir')
-        s.request = Mock()
+        s.request = Request()
         s.request.path = 'dir'
         r = list(s.get())
 
@@ -285,3 +1521,128 @@ class TestStatic(TestCase):
                          '<li><a href="dir/path2">path2</a></li>'
                          '<li><a href="dir/path3">path3</a></li></ul>')
         self.assertEqual(s.response.headers, {'Content-type': 'text/html'})
+
+    def test_dir_listing(self):
+        directory = mkdtemp()
+        try:
+            for name, size in [('b', 3), ('a', 1), ('c', 2)]:
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write('x' * size)
+
+            s = Static(directory)
+            s._DIR_BATCH_SIZE = 2
+
+            def listing(query=''):
+                s.request = Request({'QUERY_STRING': query})
+                s.request.path = ''
+                chunks = list(s.get())
+                return re.findall(r'>(\w)</a>', ''.join(chunks)), len(chunks)
+
+            self.assertEqual(listing(), (['a', 'b', 'c'], 2))
+            self.assertEqual(listing('order=desc')[0], ['c', 'b', 'a'])
+            self.assertEqual(listing('sort=size')[0], ['a', 'c', 'b'])
+            self.assertEqual(listing('sort=size&order=desc&per_page=2')[0],
+                             ['b', 'c'])
+            self.assertEqual(listing('per_page=2&page=2')[0], ['c'])
+            self.assertEqual(listing('per_page=x&sort=nope')[0],
+                             ['a', 'b', 'c'])
+            self.assertEqual(listing('per_page=-1')[0], ['a', 'b', 'c'])
+            self.assertEqual(listing('per_page=0&page=2')[0], ['a', 'b', 'c'])
+
+            with patch('os.listdir') as listdir:
+                with patch('sinpy.scandir') as scandir:
+                    listing()
+            self.assertFalse(listdir.called or scandir.called)
+
+            listing_mtime = s._listings[directory].mtime
+            with open(os.path.join(directory, 'd'), 'w') as f:
+                pass
+            os.utime(directory, (0, listing_mtime + 1))
+            self.assertEqual(listing()[0], ['a', 'b', 'c', 'd'])
+
+            # Only the most recently listed directories are kept.
+            s._DIR_LISTINGS = 1
+            os.mkdir(os.path.join(directory, 'sub'))
+            s.request = Request({'PATH_INFO': '/sub'})
+            s.request.path = '/sub'
+            list(s._iter_dir(os.path.join(directory, 'sub')))
+            self.assertEqual(list(s._listings),
+                             [os.path.join(directory, 'sub')])
+        finally:
+            rmtree(directory)
+
+
+class TestStaticCache(TestCase):
+    def setUp(self):
+        self.files = []
+        for data in '0123456789', 'abcdefghij', 'ABCDEFGHIJ':
+            f = NamedTemporaryFile()
+            f.write(data)
+            f.flush()
+            self.files.append(f)
+
+    def tearDown(self):
+        for f in self.files:
+            f.close()
+
+    def get(self, cache, f, **environ):
+        s = Static(f.name, cache=cache)
+        s.request = Request(environ)
+        return s.response, ''.join(s.get())
+
+    def test_hit(self):
+        cache = StaticCache()
+        f = self.files[0]
+
+        self.assertEqual(self.get(cache, f)[1], '0123456789')
+        with patch('sinpy.open', create=True) as m:
+            response, body = self.get(cache, f)
+            self.assertFalse(m.called)
+
+        self.assertEqual(body, '0123456789')
+        self.assertEqual(response.headers['Content-Length'], '10')
+        self.assertEqual((cache.hits, cache.misses, cache.size), (1, 1, 10))
+
+        response, body = self.get(cache, f, HTTP_RANGE='bytes=1-2,-1')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue('\r\n12\r\n' in body)
+        self.assertTrue('\r\n9\r\n' in body)
+
+    def test_precompressed_missing(self):
+        cache = StaticCache()
+        s = Static(self.files[0].name, cache=cache)
+        with patch('os.path.isfile', wraps=os.path.isfile) as isfile:
+            for _ in range(5):
+                with Context(Request({'HTTP_ACCEPT_ENCODING': 'gzip, br'})):
+                    self.assertEqual(''.join(s.get()), '0123456789')
+
+        self.assertEqual(isfile.call_count, 2)
+        self.assertEqual((cache.hits, cache.misses), (4, 3))
+
+    def test_too_large(self):
+        cache = StaticCache(max_file_size=5)
+        self.get(cache, self.files[0])
+        self.get(cache, self.files[0])
+
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 2, 0))
+
+    def test_eviction(self):
+        cache = StaticCache(max_bytes=25)
+        for f in self.files:
+            self.get(cache, f)
+        self.get(cache, self.files[2])
+
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.size, 20)
+        self.assertEqual(cache.get(self.files[0].name), None)
+        self.assertEqual(cache.get(self.files[1].name).data, 'abcdefghij')
+
+    def test_revalidate(self):
+        cache = StaticCache(stat_interval=0)
+        f = self.files[0]
+        self.get(cache, f)
+
+        f.write('X')
+        f.flush()
+        self.assertEqual(self.get(cache, f)[1], '0123456789X')
+        self.assertEqual((cache.hits, cache.misses, cache.size), (0, 2, 11))
@@ -0,0 +1,176 @@
+from unittest import skipIf, TestCase
+
+from sinpy import Request, Resource, Stream
+
+try:
+    import asyncio
+    from sinpy.asgi import ASGIApplication
+except (ImportError, SyntaxError):
+    ASGIApplication = None
+
+
+@skipIf(ASGIApplication is None, 'ASGI requires Python 3.6+')
+class TestASGIApplication(TestCase):
+    def setUp(self):
+        class Site(Resource):
+            def get(self):
+                return 'SYNC'
+
+            @Resource
+            def stream(self):
+                self.response.headers['Content-type'] = 'text/html'
+                yield '<p>'
+                yield b'STREAM'
+                yield '</p>'
+
+            @Resource
+            def coroutine(self):
+                self.response.status_code = 404
+                return asyncio.sleep(0, result='ASYNC')
+
+        self.application = ASGIApplication(Site(), max_workers=2)
+
+    def request(self, path, method='GET', body=(), **scope):
+        loop = asyncio.new_event_loop()
+        try:
+            messages = []
+            loop.run_until_complete(self.call(loop, path, method, messages,
+                                              body, **scope))
+        finally:
+            loop.close()
+        return self.result(messages)
+
+    def call(self, loop, path, method, messages, body=(), **scope):
+        body = list(body) or [b'']
+
+        def receive():
+            chunk = body.pop(0)
+            future = loop.create_future()
+            future.set_result({'type': 'http.request', 'body': chunk,
+                               'more_body': bool(body)})
+            return future
+
+        def send(message):
+            messages.append(message)
+            future = loop.create_future()
+            future.set_result(None)
+            return future
+
+        scope.update({'type': 'http', 'method': method, 'path': path})
+        return self.application(scope, receive, send)
+
+    def result(self, messages):
+        start = messages[0]
+        body = b''.join(message['body'] for message in messages[1:])
+        self.assertFalse(messages[-1].get('more_body', False))
+        return start['status'], start['headers'], body
+
+    def test_sync(self):
+        self.assertEqual(self.request('/'),
+                         (200, [(b'content-type', b'text/plain')], b'SYNC'))
+
+    def test_stream(self):
+        self.assertEqual(self.request('/stream'),
+                         (200, [(b'content-type', b'text/html')],
+                          b'<p>STREAM</p>'))
+
+    def test_head(self):
+        self.assertEqual(self.request('/stream', 'HEAD'),
+                         (200, [(b'content-type', b'text/html')], b''))
+
+    def test_async_stream(self):
+        # Async generator syntax would not compile on Python 2.
+        namespace = {}
+        exec('async def chunks():\n'
+             '    for chunk in b"a", b"b", b"c":\n'
+             '        yield chunk\n', namespace)
+        stream = Stream(namespace['chunks'](), max_buffer=1)
+        self.assertEqual(list(stream), [b'a', b'b', b'c'])
+
+    def test_coroutine(self):
+        self.assertEqual(self.request('/coroutine'),
+                         (404, [(b'content-type', b'text/plain')], b'ASYNC'))
+
+    def test_idle_streams(self):
+        streams = []
+
+        class Site(Resource):
+            def get(self):
+                return 'SYNC'
+
+            @Resource
+            def events(self):
+                streams.append(Stream())
+                return streams[-1]
+
+        self.application = ASGIApplication(Site(), max_workers=2)
+        loop = asyncio.new_event_loop()
+        try:
+            events = [[], []]
+            tasks = [loop.create_task(self.call(loop, '/events', 'GET',
+                                                messages))
+                     for messages in events]
+            root = []
+            loop.run_until_complete(asyncio.wait_for(
+                self.call(loop, '/', 'GET', root), 2))
+            self.assertEqual(self.result(root)[2], b'SYNC')
+
+            for stream in streams:
+                stream.put(b'data')
+                stream.finish()
+            loop.run_until_complete(asyncio.gather(*tasks))
+        finally:
+            loop.close()
+        for messages in events:
+            self.assertEqual(self.result(messages)[2], b'data')
+
+    def test_async_source(self):
+        loops = []
+        namespace = {'asyncio': asyncio, 'loops': loops}
+        exec('async def chunks():\n'
+             '    loops.append(asyncio.get_running_loop())\n'
+             '    yield b"a"\n'
+             '    yield b"b"\n', namespace)
+
+        class Site(Resource):
+            def get(self):
+                return Stream(namespace['chunks']())
+
+        self.application = ASGIApplication(Site(), max_workers=1)
+        loop = asyncio.new_event_loop()
+        try:
+            messages = []
+            loop.run_until_complete(self.call(loop, '/', 'GET', messages))
+        finally:
+            loop.close()
+        self.assertEqual(self.result(messages)[2], b'ab')
+        self.assertEqual(loops, [loop])
+
+    def test_request(self):
+        class Site(Resource):
+            def post(self):
+                request = self.request
+                return '%s %s %s %s' % (
+                    request.query['a'][0], request.headers['User-Agent'],
+                    request.cookies, request.body.read().decode('ascii'))
+
+        self.application = ASGIApplication(Site(), max_workers=1)
+        status, _, body = self.request(
+            '/', 'POST', [b'x=', b'1'], query_string=b'a=1',
+            headers=[(b'user-agent', b'test'), (b'cookie', b'a=1'),
+                     (b'cookie', b'b=2'), (b'content-length', b'3')])
+        self.assertEqual((status, body),
+                         (200, b"1 test {'a': '1', 'b': '2'} x=1"))
+
+    def test_request_too_large(self):
+        class Site(Resource):
+            def post(self):
+                yield self.request.body.read()
+
+        limit, Request._MAX_BODY_SIZE = Request._MAX_BODY_SIZE, 4
+        try:
+            self.application = ASGIApplication(Site(), max_workers=1)
+            status, _, body = self.request('/', 'POST', [b'abc', b'de'])
+        finally:
+            Request._MAX_BODY_SIZE = limit
+        self.assertEqual((status, body), (413, b'Request entity too large'))
@@ -0,0 +1,115 @@
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+from unittest import TestCase
+
+from sinpy import Dispatcher, Resource
+from sinpy.manifest import Manifest, RouteConflict
+
+
+class TestManifest(TestCase):
+    def setUp(self):
+        dispatcher = Dispatcher()
+
+        class Site(Resource):
+            def get(self):
+                return 'ROOT'
+
+            @dispatcher.route('about.html')
+            @Resource
+            def about(self):
+                return 'ABOUT'
+
+            class Item(Resource):
+                def get(self, id):
+                    return 'ITEM'
+
+                def delete(self, id):
+                    return 'DELETED'
+
+            _item = Item()
+            dispatcher.route(re=r'item-<int:id>')(_item)
+
+        self.dispatcher = dispatcher
+        self.Site = Site
+
+    def test_routes(self):
+        manifest = Manifest(self.Site())
+        self.assertEqual([route[:2] + route[3:] for route in manifest], [
+            ('/', 'root', ('GET', 'HEAD', 'OPTIONS'), 0),
+            ('/about', 'attribute', ('GET', 'HEAD', 'OPTIONS'), 0),
+            ('/about.html', 'string', ('GET', 'HEAD', 'OPTIONS'), 0),
+            ('/{item-(?P<id>\\d+)}', 'regex',
+             ('GET', 'HEAD', 'DELETE', 'OPTIONS'), 1),
+        ])
+        self.assertEqual([route.target.rpartition('.')[2]
+                          for route in manifest],
+                         ['Site', 'about', 'about', 'Item'])
+        self.assertEqual(set(manifest.timings(repeat=1)),
+                         set(['/', '/about', '/about.html']))
+
+    def test_timings(self):
+        called = []
+        self.Site.get = lambda self: called.append(self) or 'ROOT'
+
+        timings = Manifest(self.Site()).timings(repeat=3)
+        self.assertEqual(sorted(timings), ['/', '/about', '/about.html'])
+        self.assertEqual(called, [])
+
+    def test_unreachable(self):
+        class Contact(Resource):
+            def get(self, email):
+                return email
+
+            def post(self, email=None):
+                return 'SENT'
+
+        @self.dispatcher.route('page/<int:id_>')
+        @Resource
+        def page(self, id_):
+            return 'PAGE'
+
+        self.Site.contact = Contact()
+        self.Site.page = page
+        manifest = Manifest(self.Site())
+        routes = dict((route.path, route) for route in manifest)
+        contact = routes['/contact']
+        self.assertEqual(contact.methods, ('POST', 'OPTIONS'))
+        self.assertEqual(manifest.unreachable, [
+            '/contact: the %s handler of %s requires route parameters '
+            'this path does not capture' % (method, contact.target)
+            for method in ('GET', 'HEAD')])
+        self.assertEqual(manifest.problems, [])
+
+        # Routed members answer 404 at their bare attribute name.
+        self.assertEqual(routes['/page'].methods, ('OPTIONS',))
+        page, = [route for route in manifest
+                 if route.kind == 'regex' and route.path.startswith('/{page')]
+        self.assertEqual(page.methods, ('GET', 'HEAD', 'OPTIONS'))
+
+    def test_conflicts(self):
+        self.Site.other = Resource()
+        self.dispatcher.route('about.html')(self.Site.other)
+        self.dispatcher.route('about')(self.Site.other)
+
+        with self.assertRaises(RouteConflict) as context:
+            Manifest(self.Site())
+        self.assertEqual(str(context.exception).splitlines(), [
+            "/: route 'about.html' is claimed by both 'about' and 'other'",
+            "/: route 'about' of 'other' is shadowed by the attribute of "
+            "that name"])
+
+        self.assertEqual(len(Manifest(self.Site(), strict=False).problems), 2)
+
+    def test_save_load(self):
+        directory = mkdtemp()
+        try:
+            path = os.path.join(directory, 'routes.json')
+            manifest = Manifest(self.Site())
+            manifest.save(path)
+            self.assertEqual(Manifest.load(path), manifest)
+
+            self.Site.extra = Resource()
+            self.assertNotEqual(Manifest.load(path), Manifest(self.Site()))
+        finally:
+            rmtree(directory)
@@ -0,0 +1,65 @@
+import os
+import signal
+from time import sleep
+from unittest import skipIf, TestCase
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from sinpy import Dispatcher, Resource
+from sinpy.server import PreforkServer
+
+
+@skipIf(not hasattr(os, 'fork'), 'Prefork requires os.fork')
+class TestPreforkServer(TestCase):
+    def setUp(self):
+        dispatcher = Dispatcher()
+
+        class Site(Resource):
+            def get(self):
+                return str(os.getpid()).encode('ascii')
+
+            @dispatcher.route('echo/<int:number>')
+            @Resource
+            def echo(self, number):
+                return str(number * 2).encode('ascii')
+
+        self.server = PreforkServer(Site(), host='127.0.0.1', port=0,
+                                    workers=2, max_requests=1, quiet=True)
+        self.server._POLL_INTERVAL = 0.05
+        self.pid = os.fork()
+        if not self.pid:
+            try:
+                self.server.serve_forever()
+            finally:
+                os._exit(0)
+        self.server.socket.close()
+        self.url = 'http://127.0.0.1:%d' % self.server.address[1]
+
+    def tearDown(self):
+        if self.pid:
+            os.kill(self.pid, signal.SIGTERM)
+            self.assertEqual(os.waitpid(self.pid, 0)[1], 0)
+
+    def get(self, path):
+        for _ in range(50):
+            try:
+                return urlopen(self.url + path, timeout=5).read()
+            except IOError:
+                sleep(0.05)
+        return urlopen(self.url + path, timeout=5).read()
+
+    def test_serve(self):
+        self.assertEqual(self.get('/echo/21'), b'42')
+
+    def test_max_requests(self):
+        pids = set(self.get('/') for _ in range(4))
+        self.assertEqual(len(pids), 4)
+        self.assertFalse(str(self.pid).encode() in pids)
+
+    def test_reload(self):
+        self.assertEqual(self.get('/echo/1'), b'2')
+        os.kill(self.pid, signal.SIGHUP)
+        self.assertEqual(self.get('/echo/2'), b'4')
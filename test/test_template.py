@@ -0,0 +1,102 @@
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+from unittest import TestCase
+
+from sinpy import Context, Request, Static
+from sinpy.template import (escape, Markup, Template, TemplateError,
+                            Templates)
+
+
+class TestTemplate(TestCase):
+    def test_render(self):
+        template = Template('<h1>{{ title }}</h1>{# comment #}<ul>'
+                            '{% for i in items %}'
+                            '{% if i % 2 %}<li>{{ i }}</li>'
+                            '{% elif i == 0 %}<li>zero</li>'
+                            '{% else %}{{ separator }}{% endif %}'
+                            '{% endfor %}</ul>{{ len(items) }}')
+
+        self.assertEqual(template.render(title='<A & "B">', items=range(4),
+                                         separator=Markup('<hr>')),
+                         '<h1>&lt;A &amp; &quot;B&quot;&gt;</h1><ul>'
+                         '<li>zero</li><li>1</li><hr><li>3</li></ul>4')
+
+    def test_escape(self):
+        self.assertEqual(escape("<a href='x'>"),
+                         '&lt;a href=&#39;x&#39;&gt;')
+        self.assertEqual(escape(1.5), '1.5')
+        self.assertEqual(escape(Markup('<br>')), '<br>')
+
+    def test_stream(self):
+        template = Template('<ul>{% for i in items %}<li>{{ i }}</li>'
+                            '{% endfor %}</ul>{% flush %}<p>End</p>',
+                            batch=2)
+
+        self.assertEqual(list(template.stream({'items': range(3)})),
+                         ['<ul><li>0</li><li>1</li>', '<li>2</li></ul>',
+                          '<p>End</p>'])
+        self.assertEqual(list(template.stream({'items': range(3)}, 3)),
+                         ['<ul><li>0</li><li>1</li><li>2</li>', '</ul>',
+                          '<p>End</p>'])
+
+    def test_errors(self):
+        for source, message in [
+                ('{{ a + }}', 'page.html:1: '),
+                ('<p>\n{% for in x %}{% endfor %}', 'page.html:2: '),
+                ('{% if a %}\n{% endfor %}', 'page.html:2: unexpected endfor'),
+                ('{% else %}', 'page.html:1: unexpected else'),
+                ('{% include "a" %}', "page.html:1: unknown tag 'include'"),
+                ('{% for a in b %}', 'page.html: for not closed')]:
+            with self.assertRaises(TemplateError) as raised:
+                Template(source, 'page.html')
+            self.assertTrue(str(raised.exception).startswith(message),
+                            raised.exception)
+
+
+class TestTemplates(TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.path = os.path.join(self.directory, 'page.html')
+        self.write('<p>{{ text }}</p>', 1000)
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def write(self, source, mtime):
+        with open(self.path, 'w') as f:
+            f.write(source)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_cached(self):
+        templates = Templates(self.directory)
+        template = templates['page.html']
+        self.write('<div>{{ text }}</div>', 2000)
+
+        self.assertIs(templates.get('page.html'), template)
+        self.assertEqual(template.render(text='Hi'), '<p>Hi</p>')
+
+    def test_reload(self):
+        templates = Templates(self.directory, reload=True)
+        template = templates['page.html']
+        self.assertIs(templates['page.html'], template)
+
+        self.write('<div>{{ text }}</div>', 2000)
+        self.assertEqual(templates['page.html'].render(text='Hi'),
+                         '<div>Hi</div>')
+
+
+class TestStaticListing(TestCase):
+    def test_escaped(self):
+        directory = mkdtemp()
+        try:
+            open(os.path.join(directory, 'a<b>&c'), 'w').close()
+            s = Static(directory)
+            with Context(Request()):
+                s.request.path = 'dir'
+                self.assertEqual(''.join(s.get()),
+                                 '<h1>Directory listing</h1><ul>'
+                                 '<li><a href="dir/a&lt;b&gt;&amp;c">'
+                                 'a&lt;b&gt;&amp;c</a></li></ul>')
+        finally:
+            rmtree(directory)